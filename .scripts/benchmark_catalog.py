@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Memory benchmark for the library slide catalog.
+
+Compares the previous representation (one dict per slide, parsed from a JSON list
+of full records per deck, each repeating the presentation ID and name and holding
+its body text) with slide_catalog's slotted records, loaded through SlideIndex
+with body text left in the index. For each library size it reports the time to
+load every deck from a warm index, the memory the loaded library retains, the
+catalog's memory once body text has been loaded too (as retrieval does when it
+has to embed slides), and the time and size of encoding selected_slides.
+
+Usage: python .scripts/benchmark_catalog.py [--slides 10000 100000] [--slides-per-deck 40]
+           [--content-chars 400] [--selected 50] [--json]
+"""
+import argparse
+import gc
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from slide_catalog import Deck  # noqa: E402
+from slide_index import SlideIndex  # noqa: E402
+
+
+def _decks(slide_count, slides_per_deck, content_chars):
+    """Yields (presentation_id, name, records) in the shape extract_slides_from_presentation() returns."""
+    filler = ('lorem ipsum dolor sit amet ' * (content_chars // 27 + 1))[:content_chars]
+    for d in range(0, slide_count, slides_per_deck):
+        presentation_id = f'1{d:08d}presentation-id-of-typical-drive-length'
+        name = f'Customer briefing library deck {d // slides_per_deck}'
+        yield presentation_id, name, [{
+            'title': f'Slide {i} of deck {d // slides_per_deck}: platform overview',
+            'content': f'{filler} {i}',
+            'slide_id': f'g{d:08d}_{i}',
+            'presentation_id': presentation_id,
+            'presentation_name': name,
+            'slide_number': i + 1
+        } for i in range(min(slides_per_deck, slide_count - d))]
+
+
+def _load_dicts(path, decks):
+    # The previous SlideIndex.get(), with a connection per deck: full records, renamed after loading, then flattened.
+    slides = []
+    for presentation_id, name in decks:
+        with sqlite3.connect(path) as conn:
+            row = conn.execute('SELECT slides_json FROM decks WHERE presentation_id = ?', (presentation_id,)).fetchone()
+        records = json.loads(row[0])
+        for record in records:
+            record['presentation_name'] = name
+        slides.extend(records)
+    return slides
+
+
+def _load_catalog(index, decks):
+    loaded = []
+    for presentation_id, name in decks:
+        rows = index.get(presentation_id, 'v1', 't1')
+        loaded.append(Deck(presentation_id, name, rows, load_contents=lambda p=presentation_id: index.get_contents(p, 'v1', 't1')))
+    return loaded
+
+
+def _measure_load(load):
+    gc.collect()
+    start = time.perf_counter()
+    load()
+    seconds = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    result = load()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, retained
+
+
+def _measure_encode(selected):
+    start = time.perf_counter()
+    encoded = json.dumps({'selected_slides': selected})
+    return time.perf_counter() - start, len(encoded)
+
+
+def run(slide_count, args, work_dir):
+    index = SlideIndex(os.path.join(work_dir, f'catalog-{slide_count}.sqlite3'))
+    old_path = os.path.join(work_dir, f'dicts-{slide_count}.sqlite3')
+    conn = sqlite3.connect(old_path)
+    conn.execute('CREATE TABLE decks (presentation_id TEXT PRIMARY KEY, slides_json TEXT NOT NULL)')
+    decks = []
+    for presentation_id, name, records in _decks(slide_count, args.slides_per_deck, args.content_chars):
+        index.put(presentation_id, 'v1', 't1', name, records)
+        conn.execute('INSERT INTO decks VALUES (?, ?)', (presentation_id, json.dumps(records)))
+        decks.append((presentation_id, name))
+    conn.commit()
+    conn.close()
+
+    dicts, dicts_s, dicts_bytes = _measure_load(lambda: _load_dicts(old_path, decks))
+    catalog, catalog_s, catalog_bytes = _measure_load(lambda: _load_catalog(index, decks))
+    records = [slide for deck in catalog for slide in deck.slides]
+    step = max(1, len(records) // args.selected)
+    dict_encode_s, dict_encode_len = _measure_encode(dicts[::step][:args.selected])
+    ref_encode_s, ref_encode_len = _measure_encode([slide.reference() for slide in records[::step][:args.selected]])
+
+    tracemalloc.start()
+    for slide in records:
+        slide.content
+    text_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'slides': slide_count,
+        'dicts_load_s': dicts_s,
+        'catalog_load_s': catalog_s,
+        'dicts_mib': dicts_bytes / 2 ** 20,
+        'catalog_mib': catalog_bytes / 2 ** 20,
+        'catalog_with_text_mib': (catalog_bytes + text_bytes) / 2 ** 20,
+        'dicts_encode_ms': dict_encode_s * 1000,
+        'refs_encode_ms': ref_encode_s * 1000,
+        'dicts_response_bytes': dict_encode_len,
+        'refs_response_bytes': ref_encode_len
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--slides', type=int, nargs='+', default=[10000, 100000], help='titled slides in the library')
+    parser.add_argument('--slides-per-deck', type=int, default=40)
+    parser.add_argument('--content-chars', type=int, default=400, help='body text per slide')
+    parser.add_argument('--selected', type=int, default=50, help='slides in the selected_slides response')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='slide-catalog-') as work_dir:
+        results = [run(slide_count, args, work_dir) for slide_count in args.slides]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'slides':>8}{'load s':>9}{'-> cat':>8}{'MiB':>9}{'-> cat':>8}{'+text':>8}"
+          f"{'enc ms':>9}{'-> refs':>9}{'bytes':>9}{'-> refs':>9}")
+    for r in results:
+        print(f"{r['slides']:>8}{r['dicts_load_s']:>9.3f}{r['catalog_load_s']:>8.3f}{r['dicts_mib']:>9.1f}{r['catalog_mib']:>8.1f}"
+              f"{r['catalog_with_text_mib']:>8.1f}{r['dicts_encode_ms']:>9.3f}{r['refs_encode_ms']:>9.3f}"
+              f"{r['dicts_response_bytes']:>9}{r['refs_response_bytes']:>9}")
+
+
+if __name__ == '__main__':
+    main()
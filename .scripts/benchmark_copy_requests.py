@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Micro-benchmark for building slide copy requests.
+
+Compares the previous approach (copy.deepcopy of every page element before reading
+it) with the projection used by main._build_copy_requests, on synthetic slides
+that are heavy on images, tables and styled text.
+
+Usage: python .scripts/benchmark_copy_requests.py [--slides 25] [--repeat 5]
+"""
+import argparse
+import copy
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from main import _build_copy_requests  # noqa: E402
+
+
+def _styled_run(text):
+    return {'textRun': {'content': text, 'style': {
+        'fontFamily': 'Roboto', 'fontSize': {'magnitude': 14, 'unit': 'PT'}, 'bold': False,
+        'foregroundColor': {'opaqueColor': {'rgbColor': {'red': 0.1, 'green': 0.2, 'blue': 0.3}}}
+    }}}
+
+
+def _transform(i):
+    return {'scaleX': 1, 'scaleY': 1, 'translateX': 100000 * i, 'translateY': 50000 * i, 'unit': 'EMU'}
+
+
+def _size():
+    return {'width': {'magnitude': 3000000, 'unit': 'EMU'}, 'height': {'magnitude': 2000000, 'unit': 'EMU'}}
+
+
+def make_slide(slide_id, shapes=20, images=10, tables=3, table_size=8):
+    elements = [{'objectId': f'{slide_id}_title', 'shape': {'placeholder': {'type': 'TITLE'}, 'text': {'textElements': [_styled_run('Title\n')]}}}]
+    for i in range(shapes):
+        elements.append({'objectId': f'{slide_id}_shape{i}', 'size': _size(), 'transform': _transform(i), 'shape': {
+            'shapeType': 'TEXT_BOX',
+            'shapeProperties': {'shapeBackgroundFill': {'solidFill': {'color': {'rgbColor': {'red': 1}}}}, 'outline': {'weight': {'magnitude': 1, 'unit': 'PT'}}},
+            'text': {'textElements': [{'paragraphMarker': {'style': {}}}] + [_styled_run(f'Bullet {j} of shape {i}\n') for j in range(6)]}
+        }})
+    for i in range(images):
+        elements.append({'objectId': f'{slide_id}_image{i}', 'size': _size(), 'transform': _transform(i), 'image': {
+            'sourceUrl': f'https://example.com/image{i}.png', 'contentUrl': 'https://lh3.googleusercontent.com/' + 'x' * 400,
+            'imageProperties': {'cropProperties': {}, 'outline': {'outlineFill': {'solidFill': {'color': {'rgbColor': {}}}}}}
+        }})
+    for i in range(tables):
+        elements.append({'objectId': f'{slide_id}_table{i}', 'size': _size(), 'transform': _transform(i), 'table': {
+            'rows': table_size, 'columns': table_size,
+            'tableRows': [{'tableCells': [{'text': {'textElements': [_styled_run(f'r{r}c{c}\n')]}, 'tableCellProperties': {}} for c in range(table_size)]} for r in range(table_size)]
+        }})
+    return {'objectId': slide_id, 'pageElements': elements,
+            'pageProperties': {'pageBackgroundFill': {'solidFill': {'color': {'rgbColor': {'red': 0.9, 'green': 0.9, 'blue': 1}}}}}}
+
+
+def _deepcopy_page(page):
+    # The previous implementation deep-copied every non-placeholder element before reading it.
+    return {**page, 'pageElements': [
+        element if 'placeholder' in element.get('shape', {}) else copy.deepcopy(element)
+        for element in page['pageElements']
+    ]}
+
+
+def _measure(label, build, pages, records, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page, record in zip(pages, records):
+            build(record, page)
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    for page, record in zip(pages, records):
+        build(record, page)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    per_slide_ms = min(timings) / len(pages) * 1000
+    print(f'{label:<12} {per_slide_ms:8.3f} ms/slide   peak {peak / 1024:9.1f} KiB')
+    return per_slide_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--slides', type=int, default=25)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    pages = [make_slide(f's{i}') for i in range(args.slides)]
+    records = [{'slide_id': page['objectId'], 'presentation_id': 'bench', 'presentation_name': 'Bench', 'slide_number': i + 1} for i, page in enumerate(pages)]
+
+    projected = [_build_copy_requests(r, p) for r, p in zip(records, pages)]
+    deep_copied = [_build_copy_requests(r, _deepcopy_page(p)) for r, p in zip(records, pages)]
+    assert projected == deep_copied, 'projection must produce the same requests as deep-copying'
+
+    print(f'{args.slides} slides, {len(pages[0]["pageElements"])} elements each')
+    before = _measure('deepcopy', lambda r, p: _build_copy_requests(r, _deepcopy_page(p)), pages, records, args.repeat)
+    after = _measure('projection', _build_copy_requests, pages, records, args.repeat)
+    print(f'speed-up: {before / after:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark of the generate_presentation handler against fake Google APIs.
+
+Runs the real handler in main.py, with clients.py pointed at the in-process
+stand-ins from fake_google.py, for the create, update and speaker-notes flows
+over synthetic libraries of different sizes. Reports p50/p95 latency, the
+latency of the first (cold index) request, API calls per request and batchUpdate
+sizes. With several --build-modes the create flow runs once per mode, which
+compares element-by-element reconstruction with server-side duplication.
+--concurrency sends the iterations from several threads at once, and
+--rate-limits applies rate_limiter.py's per-API quotas, which are otherwise
+lifted so results stay comparable across library sizes. A fields= mask that
+names a field missing from the bundled discovery schemas fails the run.
+
+Usage: python .scripts/benchmark_handler.py [--decks 5 50 500] [--flows create update notes]
+           [--build-modes reconstruct duplicate] [--iterations 5] [--concurrency 1]
+           [--latency-ms 20] [--gemini-latency-ms 200] [--error-rate 0] [--rate-limits]
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPTS_DIR, '..'))
+sys.path.insert(0, SCRIPTS_DIR)
+
+FOLDER_URL = 'https://drive.google.com/drive/folders/library'
+TOPICS = ('agents and automation', 'security and compliance', 'pricing and billing', 'analytics dashboards',
+          'migration roadmap', 'observability and scaling', 'identity and networking', 'search and retrieval')
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _call(main, flask_app, body):
+    import flask
+    with flask_app.test_request_context(method='POST', json=body):
+        start = time.perf_counter()
+        response = main.generate_presentation(flask.request)
+        if isinstance(response, tuple):
+            payload, status = response[0], response[1]
+        else:
+            # Streamed responses are only complete once the body has been consumed.
+            payload, status = b''.join(response.response), response.status_code
+        return time.perf_counter() - start, status, payload
+
+
+def _presentation_request(i, **extra):
+    return {'customer_request': f'A customer briefing on {TOPICS[i % len(TOPICS)]} (variant {i})', 'duration': '30 minutes',
+            'source_folder_url': FOLDER_URL, 'user_account': 'benchmark@example.com', **extra}
+
+
+def run_scenario(main, flask_app, fake_google, flow, decks, build_mode, args, work_dir):
+    backend = fake_google.FakeBackend(
+        decks=decks, slides_per_deck=args.slides_per_deck, shapes=args.shapes, images=args.images,
+        latency=args.latency_ms / 1000, gemini_latency=args.gemini_latency_ms / 1000,
+        error_rate=args.error_rate, gemini_error_rate=args.error_rate, selected_slides=args.selected_slides
+    )
+    fake_google.install(backend)
+    # Every scenario starts with an empty slide index, so the first request is the cold one.
+    os.environ['SLIDE_INDEX_PATH'] = os.path.join(work_dir, f'{flow}-{decks}-{build_mode}-index.sqlite3')
+    os.environ['SLIDE_EMBEDDINGS_DIR'] = os.path.join(work_dir, f'{flow}-{decks}-{build_mode}-embeddings')
+
+    update_url = None
+    if flow == 'update':
+        # The deck being updated is built once, outside the measurement and without injected errors.
+        with backend.errors_disabled():
+            _, status, payload = _call(main, flask_app, _presentation_request(0))
+        if status != 200:
+            raise RuntimeError(f'Could not create the deck to update: {payload}')
+        update_url = json.loads(payload)['presentation_url']
+    notes_slides = None
+    if flow == 'notes':
+        notes_slides = [{'title': page['pageElements'][0]['shape']['text']['textElements'][0]['textRun']['content'].strip(),
+                         'content': page['pageElements'][1]['shape']['text']['textElements'][0]['textRun']['content'].strip()}
+                        for deck in list(backend.presentations.values())[:decks] for page in deck['slides']][:args.notes_slides]
+
+    backend.reset_stats()
+    main.rate_limiter._buckets.clear()
+
+    def iteration(i):
+        if flow == 'create':
+            body = _presentation_request(i, build_mode=build_mode)
+        elif flow == 'update':
+            body = _presentation_request(i + 1, slides_to_update=update_url)
+        else:
+            body = {'action': 'generate_speaker_notes', 'slides_data': notes_slides, 'stream': args.stream_notes}
+            if not args.warm_notes:
+                main._speaker_notes_cache = main.LRUCache(main._speaker_notes_cache.max_entries, main._speaker_notes_cache.ttl_seconds)
+        elapsed, status, payload = _call(main, flask_app, body)
+        if status != 200:
+            logging.warning(f'{flow} with {decks} decks returned {status}: {str(payload)[:200]}')
+        return elapsed, status
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        outcomes = list(executor.map(iteration, range(args.iterations)))
+    latencies = [elapsed for elapsed, _ in outcomes]
+    failures = sum(1 for _, status in outcomes if status != 200)
+    quotas = main.rate_limiter.stats().values()
+
+    calls = Counter({name: count / args.iterations for name, count in backend.calls.items()})
+    return {
+        'flow': flow,
+        'decks': decks,
+        'build_mode': build_mode,
+        'iterations': args.iterations,
+        'failures': failures,
+        'errors_injected': backend.errors_injected,
+        'invalid_fields': dict(backend.invalid_fields),
+        'retries': sum(q['retries'] for q in quotas),
+        'throttled_s_per_request': sum(q['throttled_seconds'] for q in quotas) / args.iterations,
+        'cold_s': latencies[0],
+        'p50_s': _percentile(latencies, 0.5),
+        'p95_s': _percentile(latencies, 0.95),
+        'calls_per_request': dict(sorted(calls.items())),
+        'batch_updates_per_request': len(backend.batch_sizes) / args.iterations,
+        'mean_batch_size': sum(backend.batch_sizes) / len(backend.batch_sizes) if backend.batch_sizes else 0,
+        'max_batch_size': max(backend.batch_sizes, default=0)
+    }
+
+
+def _print_table(results):
+    print(f"{'flow':<8}{'mode':<13}{'decks':>6}{'cold s':>9}{'p50 s':>9}{'p95 s':>9}{'calls/req':>11}{'batches':>9}{'mean sz':>9}{'max sz':>8}"
+          f"{'retries':>9}{'thr s/req':>11}{'fail':>6}")
+    for r in results:
+        print(f"{r['flow']:<8}{r['build_mode']:<13}{r['decks']:>6}{r['cold_s']:>9.3f}{r['p50_s']:>9.3f}{r['p95_s']:>9.3f}"
+              f"{sum(r['calls_per_request'].values()):>11.1f}{r['batch_updates_per_request']:>9.1f}"
+              f"{r['mean_batch_size']:>9.1f}{r['max_batch_size']:>8}{r['retries']:>9}{r['throttled_s_per_request']:>11.3f}{r['failures']:>6}")
+    print()
+    for r in results:
+        breakdown = ', '.join(f'{name} {count:g}' for name, count in r['calls_per_request'].items())
+        print(f"{r['flow']}/{r['build_mode']}/{r['decks']}: {breakdown}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--decks', type=int, nargs='+', default=[5, 50, 500], help='library sizes to run')
+    parser.add_argument('--flows', nargs='+', choices=('create', 'update', 'notes'), default=['create', 'update', 'notes'])
+    parser.add_argument('--build-modes', nargs='+', choices=('reconstruct', 'duplicate'), default=['reconstruct'],
+                        help='build modes to compare on the create flow; other flows use the first')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=1, help='iterations in flight at once')
+    parser.add_argument('--slides-per-deck', type=int, default=20)
+    parser.add_argument('--shapes', type=int, default=4, help='styled shapes per synthetic slide')
+    parser.add_argument('--images', type=int, default=2, help='images per synthetic slide')
+    parser.add_argument('--selected-slides', type=int, default=15, help='slides the fake Gemini selects per deck')
+    parser.add_argument('--notes-slides', type=int, default=20, help='slides sent to the speaker-notes flow')
+    parser.add_argument('--stream-notes', action='store_true', help='use the server-sent-events notes response')
+    parser.add_argument('--warm-notes', action='store_true', help='keep the speaker-notes cache between iterations')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='mean Drive/Slides call latency')
+    parser.add_argument('--gemini-latency-ms', type=float, default=200.0, help='mean Gemini call latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls failing with a retryable error')
+    parser.add_argument('--rate-limits', action='store_true', help="keep rate_limiter.py's default quotas")
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--log-level', default='ERROR')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
+
+    with tempfile.TemporaryDirectory(prefix='slide-benchmark-') as work_dir:
+        os.environ.setdefault('PROJECT_ID', 'benchmark-project')
+        os.environ.setdefault('REGION', 'us-central1')
+        os.environ['JOB_STORE_PATH'] = os.path.join(work_dir, 'jobs.sqlite3')
+        # Request traces go to stdout and would interleave with the results.
+        os.environ.setdefault('TRACE_LOGS', '0')
+        # Scenarios repeat the same requests; cached Gemini answers would skew later ones.
+        os.environ.setdefault('GEMINI_CACHE_BACKEND', 'off')
+        if not args.rate_limits:
+            for name in ('slides_read', 'slides_write', 'drive', 'vertex', 'vertex_embedding'):
+                os.environ.setdefault(f'RATE_LIMIT_{name.upper()}', '0')
+        import flask
+        import fake_google
+        import main as handler
+
+        # Import the SDKs up front so each scenario's first request measures a cold
+        # slide index, not imports; benchmark_startup.py covers cold starts.
+        handler.clients._load_discovery()
+        handler.clients._load_vertex()
+        flask_app = flask.Flask('benchmark')
+        results = [run_scenario(handler, flask_app, fake_google, flow, decks, build_mode, args, work_dir)
+                   for decks in args.decks for flow in args.flows
+                   for build_mode in (args.build_modes if flow == 'create' else args.build_modes[:1])]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        _print_table(results)
+
+    invalid_fields = sorted({selection for r in results for selection in r['invalid_fields']})
+    if invalid_fields:
+        print('Requests with invalid field masks:\n  ' + '\n  '.join(invalid_fields), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Cold-start benchmark: import time of main.py and first-request latency per action.
+
+Every run starts a fresh interpreter, imports main.py the way the Functions
+Framework does, then sends one request for a single action against the
+in-process fakes from fake_google.py (with no simulated latency, so the first
+request measures imports and setup rather than the network). Also lists which
+heavy SDKs were already loaded by the import alone, so a module-level import
+that slips back in shows up immediately.
+
+Usage: python .scripts/benchmark_startup.py [--actions options get_config ...] [--runs 5]
+           [--max-import-ms 500] [--json]
+"""
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(SCRIPTS_DIR, '..')
+
+# Modules that only the actions needing them should import.
+HEAVY_MODULES = ('vertexai', 'googleapiclient.discovery', 'googleapiclient.http', 'httplib2', 'numpy', 'google.api_core.exceptions')
+
+ACTIONS = {
+    'options': ('OPTIONS', None),
+    'get_config': ('POST', {'action': 'get_config'}),
+    'job_status': ('POST', {'action': 'job_status', 'job_id': 'unknown'}),
+    'generate_speaker_notes': ('POST', {'action': 'generate_speaker_notes', 'slides_data': [{'title': 'Roadmap', 'content': 'Next quarter'}]}),
+    'generate_presentation': ('POST', {'customer_request': 'A customer briefing on agents', 'duration': '30 minutes',
+                                       'source_folder_url': 'https://drive.google.com/drive/folders/library',
+                                       'user_account': 'benchmark@example.com'}),
+}
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _child(action):
+    """Runs in the fresh interpreter: imports main, sends one request and prints its timings as JSON."""
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, SCRIPTS_DIR)
+    start = time.perf_counter()
+    import main
+    import_s = time.perf_counter() - start
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    import flask
+    import fake_google
+    fake_google.install(fake_google.FakeBackend())
+
+    method, body = ACTIONS[action]
+    with flask.Flask('startup').test_request_context(method=method, json=body):
+        start = time.perf_counter()
+        response = main.generate_presentation(flask.request)
+        if isinstance(response, tuple):
+            status = response[1]
+        else:
+            b''.join(response.response)
+            status = response.status_code
+        first_request_s = time.perf_counter() - start
+    print(json.dumps({'import_s': import_s, 'first_request_s': first_request_s, 'status': status, 'loaded_at_import': loaded}))
+
+
+def _run(action, work_dir):
+    env = {
+        **os.environ,
+        'PROJECT_ID': 'benchmark-project',
+        'REGION': 'us-central1',
+        # Behave like a deployed function, which skips the .env lookup.
+        'K_SERVICE': 'benchmark',
+        'TRACE_LOGS': '0',
+        'SLIDE_INDEX_PATH': os.path.join(work_dir, 'index.sqlite3'),
+        'SLIDE_EMBEDDINGS_DIR': os.path.join(work_dir, 'embeddings'),
+        'JOB_STORE_PATH': os.path.join(work_dir, 'jobs.sqlite3'),
+    }
+    # The slide index must be cold for every run.
+    for name in ('index.sqlite3', 'jobs.sqlite3'):
+        if os.path.exists(os.path.join(work_dir, name)):
+            os.remove(os.path.join(work_dir, name))
+    output = subprocess.run([sys.executable, __file__, '--child', action], env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--actions', nargs='+', choices=list(ACTIONS), default=list(ACTIONS))
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per action')
+    parser.add_argument('--max-import-ms', type=float, help='exit with status 1 if the median import time exceeds this')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--child', choices=list(ACTIONS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        _child(args.child)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='slide-startup-') as work_dir:
+        for action in args.actions:
+            runs = [_run(action, work_dir) for _ in range(args.runs)]
+            results.append({
+                'action': action,
+                'runs': args.runs,
+                'status': runs[-1]['status'],
+                'import_p50_s': _percentile([r['import_s'] for r in runs], 0.5),
+                'first_request_p50_s': _percentile([r['first_request_s'] for r in runs], 0.5),
+                'first_request_max_s': max(r['first_request_s'] for r in runs),
+                'loaded_at_import': runs[-1]['loaded_at_import']
+            })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'action':<24}{'status':>7}{'import s':>10}{'first req s':>13}{'max s':>9}  heavy modules loaded by import")
+        for r in results:
+            print(f"{r['action']:<24}{r['status']:>7}{r['import_p50_s']:>10.3f}{r['first_request_p50_s']:>13.3f}"
+                  f"{r['first_request_max_s']:>9.3f}  {', '.join(r['loaded_at_import']) or '-'}")
+
+    import_p50_ms = 1000 * _percentile([r['import_p50_s'] for r in results], 0.5)
+    if args.max_import_ms is not None and import_p50_ms > args.max_import_ms:
+        print(f"Median import time {import_p50_ms:.0f} ms exceeds --max-import-ms {args.max_import_ms:.0f}.", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
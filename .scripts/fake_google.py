@@ -0,0 +1,524 @@
+"""In-process stand-ins for the Drive, Slides and Vertex AI clients used by main.py.
+
+install() points clients.py at a FakeBackend, so the real handler runs unchanged
+against a synthetic slide library with configurable latency and error injection.
+The backend applies batchUpdate requests to its in-memory decks, so created decks
+can be read back and updated, and it counts every call for reporting.
+"""
+import copy
+import json
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+
+PRESENTATION_MIME_TYPE = 'application/vnd.google-apps.presentation'
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+LIBRARY_FOLDER_ID = 'library'
+
+_WORDS = ('agents pricing security roadmap migration analytics latency search retrieval storage '
+          'compliance onboarding identity networking billing observability scaling support training '
+          'governance integration workflow automation forecasting dashboards').split()
+
+
+def _http_error(status, message):
+    # Imported here rather than at module level so benchmark_startup.py can measure
+    # the handler's own first use of the HTTP stack.
+    import httplib2
+    from googleapiclient.errors import HttpError
+    return HttpError(httplib2.Response({'status': status}), json.dumps({'error': {'code': status, 'message': message}}).encode('utf-8'))
+
+
+# The discovery documents bundled with googleapiclient, which clients.py builds from.
+API_VERSIONS = {'drive': 'v3', 'slides': 'v1'}
+_discovery_documents = {}
+
+
+def _discovery_document(api):
+    if api not in _discovery_documents:
+        import googleapiclient
+        path = os.path.join(os.path.dirname(googleapiclient.__file__), 'discovery_cache', 'documents', f'{api}.{API_VERSIONS[api]}.json')
+        with open(path) as f:
+            _discovery_documents[api] = json.load(f)
+    return _discovery_documents[api]
+
+
+def _split_selection(selection):
+    """Splits a field selection on the commas outside parentheses."""
+    items, depth, start = [], 0, 0
+    for i, char in enumerate(selection):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            items.append(selection[start:i])
+            start = i + 1
+    if depth:
+        raise ValueError(f"Unbalanced parentheses in field selection '{selection}'")
+    items.append(selection[start:])
+    return [item.strip() for item in items if item.strip()]
+
+
+def _field_schema(schemas, schema, name, path):
+    while '$ref' in schema or schema.get('type') == 'array':
+        schema = schemas[schema['$ref']] if '$ref' in schema else schema['items']
+    if name == '*' or 'additionalProperties' in schema:
+        return schema.get('additionalProperties', {})
+    properties = schema.get('properties')
+    if properties is None:
+        # Free-form objects accept any sub-selection.
+        return {}
+    if name not in properties:
+        raise ValueError(f"Invalid field selection {path}")
+    return properties[name]
+
+
+def _check_selection(schemas, schema, selection, prefix=''):
+    for item in _split_selection(selection):
+        names, _, sub_selection = item.partition('(')
+        target = schema
+        path = prefix
+        for name in names.strip().split('/'):
+            path = f'{path}.{name}' if path else name
+            target = _field_schema(schemas, target, name, path)
+        if sub_selection:
+            if not sub_selection.endswith(')'):
+                raise ValueError(f"Invalid field selection {item}")
+            _check_selection(schemas, target, sub_selection[:-1], path)
+
+
+def check_fields(api, method, fields):
+    """Raises ValueError if a fields= selection names a field the method's response schema lacks.
+
+    method is the dotted resource path, e.g. 'presentations.pages.get'. Google APIs
+    answer such selections with a 400, so a wrong mask must fail here too.
+    """
+    document = _discovery_document(api)
+    *resources, method_name = method.split('.')
+    node = document
+    for resource in resources:
+        node = node['resources'][resource]
+    response = node['methods'][method_name]['response']
+    _check_selection(document['schemas'], response, fields)
+
+
+def _text_run(text, link=None):
+    style = {'fontFamily': 'Roboto', 'fontSize': {'magnitude': 14, 'unit': 'PT'}, 'bold': False}
+    if link:
+        style['link'] = {'url': link}
+    return {'textRun': {'content': text, 'style': style}}
+
+
+def _size():
+    return {'width': {'magnitude': 3000000, 'unit': 'EMU'}, 'height': {'magnitude': 2000000, 'unit': 'EMU'}}
+
+
+def _transform(i):
+    return {'scaleX': 1, 'scaleY': 1, 'translateX': 100000 * i, 'translateY': 50000 * i, 'unit': 'EMU'}
+
+
+def make_deck(deck_number, slides, shapes, images, rng):
+    """Builds one synthetic presentation with titled slides, body text, styled shapes and images."""
+    presentation_id = f'deck{deck_number:04d}'
+    pages = []
+    for s in range(slides):
+        slide_id = f'{presentation_id}_s{s}'
+        topic = ' '.join(rng.sample(_WORDS, 3))
+        elements = [
+            {'objectId': f'{slide_id}_title', 'shape': {'shapeType': 'TEXT_BOX', 'placeholder': {'type': 'TITLE'},
+                                                      'text': {'textElements': [_text_run(f'Deck {deck_number} slide {s}: {topic}\n')]}}},
+            {'objectId': f'{slide_id}_body', 'shape': {'shapeType': 'TEXT_BOX', 'placeholder': {'type': 'BODY'},
+                                                     'text': {'textElements': [_text_run(' '.join(rng.choices(_WORDS, k=30)) + '\n')]}}},
+        ]
+        for i in range(shapes):
+            elements.append({'objectId': f'{slide_id}_shape{i}', 'size': _size(), 'transform': _transform(i), 'shape': {
+                'shapeType': 'RECTANGLE',
+                'shapeProperties': {'shapeBackgroundFill': {'solidFill': {'color': {'rgbColor': {'red': 1}}}}},
+                'text': {'textElements': [_text_run(f'Callout {i}\n')]}
+            }})
+        for i in range(images):
+            elements.append({'objectId': f'{slide_id}_image{i}', 'size': _size(), 'transform': _transform(i), 'image': {
+                'sourceUrl': f'https://example.com/{slide_id}/image{i}.png',
+                'contentUrl': 'https://lh3.googleusercontent.com/' + 'x' * 400
+            }})
+        pages.append({'objectId': slide_id, 'pageElements': elements, 'slideProperties': {},
+                      'pageProperties': {'pageBackgroundFill': {'solidFill': {'color': {'rgbColor': {'blue': 0.2 * (s % 5)}}}}}})
+    return {'presentationId': presentation_id, 'title': f'Deck {deck_number}', 'slides': pages}
+
+
+class FakeBackend:
+    """Shared state and instrumentation behind every fake client.
+
+    latency and gemini_latency are mean per-call delays in seconds (jittered by
+    +/-50%). error_rate is the share of Drive and Slides calls that fail with a
+    retryable 429 or 503; gemini_error_rate does the same for Vertex AI.
+    """
+
+    def __init__(self, decks=5, slides_per_deck=20, shapes=4, images=2, latency=0.0, gemini_latency=0.0,
+                 error_rate=0.0, gemini_error_rate=0.0, selected_slides=15, seed=0):
+        self.latency = latency
+        self.gemini_latency = gemini_latency
+        self.error_rate = error_rate
+        self.gemini_error_rate = gemini_error_rate
+        self.selected_slides = selected_slides
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.presentations = {}
+        self.files = {}
+        for d in range(decks):
+            deck = make_deck(d, slides_per_deck, shapes, images, self._rng)
+            self.presentations[deck['presentationId']] = deck
+            self.files[deck['presentationId']] = {'id': deck['presentationId'], 'name': deck['title'], 'mimeType': PRESENTATION_MIME_TYPE,
+                                                  'parent': LIBRARY_FOLDER_ID, 'version': '1', 'modifiedTime': '2025-01-01T00:00:00Z'}
+        self._next_id = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = Counter()
+            self.batch_sizes = []
+            self.errors_injected = 0
+            self.invalid_fields = Counter()
+
+    @contextmanager
+    def errors_disabled(self):
+        """Suspends error injection, e.g. while setting up a scenario."""
+        rates = self.error_rate, self.gemini_error_rate
+        self.error_rate = self.gemini_error_rate = 0.0
+        try:
+            yield
+        finally:
+            self.error_rate, self.gemini_error_rate = rates
+
+    def _call(self, name, gemini=False):
+        """Counts a call, waits out its latency and possibly injects a retryable error."""
+        with self._lock:
+            self.calls[name] += 1
+            fail = self._rng.random() < (self.gemini_error_rate if gemini else self.error_rate)
+            if fail:
+                self.errors_injected += 1
+        delay = self.gemini_latency if gemini else self.latency
+        if delay:
+            time.sleep(delay * random.uniform(0.5, 1.5))
+        if fail:
+            if gemini:
+                from google.api_core import exceptions as google_exceptions
+                raise google_exceptions.ResourceExhausted('Injected quota error')
+            status = random.choice((429, 503))
+            raise _http_error(status, 'Injected error')
+
+    def _new_id(self, prefix):
+        with self._lock:
+            self._next_id += 1
+            return f'{prefix}{self._next_id:05d}'
+
+    # --- Drive ---
+
+    def list_files(self, q, page_size, page_token):
+        self._call('drive.files.list')
+        folder_id = re.search(r"'([^']+)' in parents", q).group(1)
+        mime_types = set(re.findall(r"mimeType='([^']+)'", q))
+        matching = [f for f in self.files.values() if f['parent'] == folder_id and f['mimeType'] in mime_types]
+        start = int(page_token or 0)
+        page_size = page_size or 100
+        response = {'files': [{k: v for k, v in f.items() if k != 'parent'} for f in matching[start:start + page_size]]}
+        if start + page_size < len(matching):
+            response['nextPageToken'] = str(start + page_size)
+        return response
+
+    def get_file(self, file_id):
+        self._call('drive.files.get')
+        if file_id not in self.files:
+            raise _http_error(404, 'File not found')
+        return {k: v for k, v in self.files[file_id].items() if k != 'parent'}
+
+    def copy_file(self, file_id, body):
+        self._call('drive.files.copy')
+        new_id = self._new_id('copy')
+        with self._lock:
+            deck = copy.deepcopy(self.presentations[file_id])
+            deck['presentationId'] = new_id
+            deck['title'] = (body or {}).get('name', deck['title'])
+            self.presentations[new_id] = deck
+            self.files[new_id] = {**self.files[file_id], 'id': new_id, 'name': deck['title'], 'parent': 'outputs'}
+        return {'id': new_id, 'name': deck['title']}
+
+    def delete_file(self, file_id):
+        self._call('drive.files.delete')
+        with self._lock:
+            self.presentations.pop(file_id, None)
+            self.files.pop(file_id, None)
+        return {}
+
+    def create_permission(self):
+        self._call('drive.permissions.create')
+        return {}
+
+    # --- Slides ---
+
+    def get_presentation(self, presentation_id):
+        self._call('slides.presentations.get')
+        with self._lock:
+            if presentation_id not in self.presentations:
+                raise _http_error(404, 'Presentation not found')
+            return copy.deepcopy(self.presentations[presentation_id])
+
+    def get_page(self, presentation_id, page_id):
+        self._call('slides.pages.get')
+        with self._lock:
+            return copy.deepcopy(next(p for p in self.presentations[presentation_id]['slides'] if p['objectId'] == page_id))
+
+    def create_presentation(self, body):
+        self._call('slides.presentations.create')
+        new_id = self._new_id('new')
+        deck = {'presentationId': new_id, 'title': body.get('title'), 'slides': [{'objectId': f'{new_id}_default', 'pageElements': []}]}
+        with self._lock:
+            self.presentations[new_id] = deck
+            self.files[new_id] = {'id': new_id, 'name': body.get('title'), 'mimeType': PRESENTATION_MIME_TYPE, 'parent': 'outputs',
+                                  'version': '1', 'modifiedTime': '2025-01-01T00:00:00Z'}
+            return copy.deepcopy(deck)
+
+    def batch_update(self, presentation_id, requests):
+        self._call('slides.presentations.batchUpdate')
+        with self._lock:
+            self.batch_sizes.append(len(requests))
+            # batchUpdate is atomic: apply to a copy and keep it only if every request succeeds.
+            deck = copy.deepcopy(self.presentations[presentation_id])
+            for index, request in enumerate(requests):
+                error = _apply(deck, request)
+                if error:
+                    message = f'Invalid requests[{index}].{next(iter(request))}: {error}'
+                    raise _http_error(400, message)
+            self.presentations[presentation_id] = deck
+        return {'replies': [{} for _ in requests]}
+
+    # --- Vertex AI ---
+
+    def generate(self, prompt, stream):
+        self._call('vertex.generate_content', gemini=True)
+        if 'selected_slides' in prompt:
+            titles = json.loads(re.search(r'Available Slides: (\[.*\])', prompt).group(1))
+            # Deterministic per request, so repeated runs select the same slides.
+            rng = random.Random(zlib.crc32(prompt.split('Their request is:')[1][:200].encode('utf-8')))
+            selection = rng.sample(titles, min(self.selected_slides, len(titles)))
+            text = f"```json\n{json.dumps({'selected_slides': selection})}\n```"
+        elif 'speaker notes' in prompt:
+            titles = re.findall(r'Slide Title: (.*)', prompt)
+            text = '\n\n'.join(f'# {title}\n- Open with the key takeaway.\n- Pause for questions.' for title in titles)
+        else:
+            text = '- Introduction\n- Discussion\n- Next steps'
+        if stream:
+            return iter(SimpleNamespace(text=text[i:i + 200]) for i in range(0, len(text), 200))
+        return SimpleNamespace(text=text)
+
+
+def _find_page(deck, object_id):
+    return next((page for page in deck['slides'] if page['objectId'] == object_id), None)
+
+
+def _find_element(deck, object_id):
+    for page in deck['slides']:
+        for element in page.get('pageElements', []):
+            if element['objectId'] == object_id:
+                return page, element
+    return None, None
+
+
+def _object_exists(deck, object_id):
+    return _find_page(deck, object_id) is not None or _find_element(deck, object_id)[1] is not None
+
+
+def _apply(deck, request):
+    """Applies one batchUpdate sub-request to a deck, returning an error message if it is invalid."""
+    kind, body = next(iter(request.items()))
+    object_id = body.get('objectId')
+    if kind in ('createSlide', 'createShape', 'createImage') and object_id and _object_exists(deck, object_id):
+        return f'The object ID ({object_id}) should be unique.'
+    if kind == 'createSlide':
+        index = body.get('insertionIndex', len(deck['slides']))
+        elements = [{'objectId': m['objectId'], 'shape': {'shapeType': 'TEXT_BOX', 'placeholder': m['layoutPlaceholder'], 'text': {'textElements': []}}}
+                    for m in body.get('placeholderIdMappings', [])]
+        deck['slides'].insert(index, {'objectId': object_id, 'pageElements': elements, 'slideProperties': {}})
+    elif kind in ('createShape', 'createImage'):
+        page = _find_page(deck, body['elementProperties']['pageObjectId'])
+        if page is None:
+            return 'The page does not exist.'
+        element = {'objectId': object_id, 'size': body['elementProperties'].get('size'), 'transform': body['elementProperties'].get('transform')}
+        if kind == 'createShape':
+            element['shape'] = {'shapeType': body.get('shapeType'), 'text': {'textElements': []}}
+        else:
+            element['image'] = {'sourceUrl': body.get('url')}
+        page['pageElements'].append(element)
+    elif kind == 'insertText':
+        _, element = _find_element(deck, object_id)
+        if element is None:
+            return f'The object ({object_id}) could not be found.'
+        element['shape']['text']['textElements'].append(_text_run(body.get('text', '')))
+    elif kind == 'updateTextStyle':
+        _, element = _find_element(deck, object_id)
+        if element is None:
+            return f'The object ({object_id}) could not be found.'
+        for text_element in element['shape']['text']['textElements']:
+            text_element['textRun']['style'].update(body.get('style', {}))
+    elif kind in ('updateShapeProperties', 'updatePageProperties'):
+        if not _object_exists(deck, object_id):
+            return f'The object ({object_id}) could not be found.'
+    elif kind == 'deleteObject':
+        page = _find_page(deck, object_id)
+        if page is not None:
+            deck['slides'].remove(page)
+        else:
+            page, element = _find_element(deck, object_id)
+            if element is None:
+                return f'The object ({object_id}) could not be found.'
+            page['pageElements'].remove(element)
+    elif kind == 'updateSlidesPosition':
+        pages = [_find_page(deck, slide_id) for slide_id in body['slideObjectIds']]
+        if None in pages:
+            return 'A slide to move could not be found.'
+        index = body['insertionIndex'] - sum(1 for page in pages if deck['slides'].index(page) < body['insertionIndex'])
+        for page in pages:
+            deck['slides'].remove(page)
+        deck['slides'][index:index] = pages
+    elif kind == 'duplicateObject':
+        page = _find_page(deck, object_id)
+        if page is None:
+            return f'The object ({object_id}) could not be found.'
+        id_map = body.get('objectIds', {})
+        duplicate = copy.deepcopy(page)
+        duplicate['objectId'] = id_map.get(object_id, f'{object_id}_dup')
+        for element in duplicate.get('pageElements', []):
+            element['objectId'] = id_map.get(element['objectId'], f"{element['objectId']}_dup")
+        deck['slides'].insert(deck['slides'].index(page) + 1, duplicate)
+    else:
+        return f'Unsupported request type {kind}.'
+    return None
+
+
+class _Request:
+    def __init__(self, func, quota, backend=None, method=None, fields=None, idempotent=False):
+        self._func = func
+        self._quota = quota
+        self._idempotent = idempotent
+        self._backend = backend
+        self._method = method
+        self._fields = fields
+
+    def execute(self, **kwargs):
+        if self._fields:
+            api, method = self._method.split('.', 1)
+            try:
+                check_fields(api, method, self._fields)
+            except ValueError as err:
+                with self._backend._lock:
+                    self._backend.invalid_fields[f'{self._method}: {err}'] += 1
+                raise _http_error(400, str(err))
+        # Throttled and retried like traced_http.TracedHttpRequest.execute().
+        import rate_limiter
+        return rate_limiter.call(self._quota, self._func, idempotent=self._idempotent)
+
+
+class _Files:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def list(self, q=None, pageSize=None, pageToken=None, fields=None, **kwargs):
+        return _Request(lambda: self._backend.list_files(q, pageSize, pageToken), 'drive', self._backend, 'drive.files.list', fields, idempotent=True)
+
+    def get(self, fileId=None, fields=None, **kwargs):
+        return _Request(lambda: self._backend.get_file(fileId), 'drive', self._backend, 'drive.files.get', fields, idempotent=True)
+
+    def copy(self, fileId=None, body=None, fields=None, **kwargs):
+        return _Request(lambda: self._backend.copy_file(fileId, body), 'drive', self._backend, 'drive.files.copy', fields)
+
+    def delete(self, fileId=None, **kwargs):
+        return _Request(lambda: self._backend.delete_file(fileId), 'drive')
+
+
+class _Permissions:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def create(self, **kwargs):
+        return _Request(self._backend.create_permission, 'drive')
+
+
+class _Pages:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def get(self, presentationId=None, pageObjectId=None, fields=None, **kwargs):
+        return _Request(lambda: self._backend.get_page(presentationId, pageObjectId), 'slides_read',
+                        self._backend, 'slides.presentations.pages.get', fields, idempotent=True)
+
+
+class _Presentations:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def get(self, presentationId=None, fields=None, **kwargs):
+        return _Request(lambda: self._backend.get_presentation(presentationId), 'slides_read',
+                        self._backend, 'slides.presentations.get', fields, idempotent=True)
+
+    def create(self, body=None, **kwargs):
+        return _Request(lambda: self._backend.create_presentation(body or {}), 'slides_write')
+
+    def batchUpdate(self, presentationId=None, body=None, **kwargs):
+        return _Request(lambda: self._backend.batch_update(presentationId, body['requests']), 'slides_write')
+
+    def pages(self):
+        return _Pages(self._backend)
+
+
+class FakeService:
+    """Discovery-client lookalike exposing the Drive and Slides resources main.py uses."""
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def files(self):
+        return _Files(self._backend)
+
+    def permissions(self):
+        return _Permissions(self._backend)
+
+    def presentations(self):
+        return _Presentations(self._backend)
+
+
+def install(backend):
+    """Routes clients.py's Google API, credential and Vertex AI entry points to backend."""
+    import clients
+
+    class FakeGenerativeModel:
+        def __init__(self, model_name, *args, **kwargs):
+            self.model_name = model_name
+            self._prediction_client = None
+
+        def generate_content(self, prompt, stream=False, **kwargs):
+            return backend.generate(prompt, stream)
+
+    # The real SDK modules are still imported on first use, like clients.py does,
+    # so cold-start measurements include their import cost.
+    def load_discovery():
+        import googleapiclient.discovery  # noqa: F401
+        import traced_http
+        return (lambda name, version, **kwargs: FakeService(backend)), traced_http.TracedHttpRequest
+
+    def load_vertex():
+        import vertexai.generative_models  # noqa: F401
+        import vertexai.language_models  # noqa: F401
+        return SimpleNamespace(init=lambda **kwargs: None), FakeGenerativeModel, None
+
+    credentials = SimpleNamespace(service_account_email='benchmark@example.iam.gserviceaccount.com', token='fake', valid=True)
+    clients._load_discovery = load_discovery
+    clients._load_vertex = load_vertex
+    clients.google.auth.default = lambda scopes=None: (credentials, 'benchmark-project')
+    clients._pool.clear()
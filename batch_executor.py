@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from googleapiclient.errors import HttpError
+
+import pipeline
+
+# Upper bound on sub-requests per batchUpdate call. Override with BATCH_MAX_REQUESTS.
+DEFAULT_MAX_REQUESTS_PER_BATCH = 400
+# Once the API has rejected this many requests of one type, the rest of that type is
+# dropped from the chunk at once instead of costing a batchUpdate round trip each.
+REPEATED_REJECTIONS = 2
+# Requests that create a page element; the slide's later requests on that element need it.
+_CREATE_ELEMENT_REQUESTS = ('createShape', 'createImage', 'createTable', 'createLine', 'createVideo', 'createSheetsChart')
+
+
+def _error_message(err):
+    try:
+        return json.loads(err.content.decode('utf-8'))['error']['message']
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return str(err)
+
+
+def _failed_request_index(err):
+    """Returns the index of the sub-request a 400 response blames, e.g. 'Invalid requests[12].createImage'."""
+    match = re.search(r'requests\[(\d+)\]', _error_message(err))
+    return int(match.group(1)) if match else None
+
+
+def _target_object_id(request):
+    body = next(iter(request.values()), {})
+    return body.get('objectId') if isinstance(body, dict) else None
+
+
+class BatchExecutor:
+    """Sends batchUpdate requests for one presentation in ordered, size-capped chunks.
+
+    Requests are added in groups (one group per slide) so that a chunk never splits
+    a slide. Chunks are sent on a background thread while the caller keeps building
+    requests. Throttling (429) and unavailability (503) are retried by the rate limiter; other
+    server errors are not, since the chunk may already have been applied. A rejected
+    chunk has its failing sub-request dropped instead of failing the whole deck.
+    on_sent, if given, is called from the sender thread with the labels of the
+    groups each successful batchUpdate call applied.
+    """
+
+    def __init__(self, slides_service, presentation_id, max_requests=None, on_sent=None):
+        self.slides_service = slides_service
+        self.presentation_id = presentation_id
+        self.on_sent = on_sent
+        self.max_requests = max_requests or int(os.environ.get('BATCH_MAX_REQUESTS', DEFAULT_MAX_REQUESTS_PER_BATCH))
+        self.batch_sizes = []
+        self.skipped = []
+        self._rejections = Counter()
+        self._pending = []
+        self._pending_size = 0
+        self._futures = []
+        self._failed = False
+        self._sender = ThreadPoolExecutor(max_workers=1)
+
+    def add(self, label, requests):
+        """Queues the requests that build one slide; label identifies the slide in the skip report."""
+        if not requests:
+            return
+        if self._pending and self._pending_size + len(requests) > self.max_requests:
+            self._flush()
+        self._pending.append((label, list(requests)))
+        self._pending_size += len(requests)
+
+    def close(self):
+        """Sends any buffered requests, waits for every chunk and returns the list of skipped sub-requests."""
+        self._flush()
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._sender.shutdown()
+        return self.skipped
+
+    def _flush(self):
+        if self._pending:
+            self._futures.append(self._sender.submit(pipeline.propagate(self._send_chunk), self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def _send_chunk(self, groups):
+        # A fatal error in an earlier chunk leaves the deck half-built; stop sending.
+        if self._failed:
+            return
+        try:
+            self._send_groups(groups)
+        except Exception:
+            self._failed = True
+            raise
+
+    def _send_groups(self, groups):
+        while groups:
+            requests = [request for _, group in groups for request in group]
+            try:
+                self._execute(requests)
+                self.batch_sizes.append(len(requests))
+                if self.on_sent:
+                    self.on_sent([label for label, _ in groups])
+                return
+            except HttpError as err:
+                if err.resp.status != 400:
+                    raise
+                # batchUpdate is atomic, so nothing from the rejected chunk was applied.
+                index = _failed_request_index(err)
+                if index is None or index >= len(requests):
+                    if len(groups) == 1:
+                        self._skip(groups[0][0], None, _error_message(err))
+                        return
+                    # The error does not say which sub-request failed; bisect along slide boundaries.
+                    middle = len(groups) // 2
+                    self._send_groups(groups[:middle])
+                    self._send_groups(groups[middle:])
+                    return
+                groups = self._drop_request(groups, index, err)
+
+    def _drop_request(self, groups, index, err):
+        """Removes the failing sub-request, and the requests in its slide that need what it would have created.
+
+        A failed update only loses itself. Once its type has been rejected
+        REPEATED_REJECTIONS times, every request of that type left in the chunk is
+        dropped along with it.
+        """
+        message = _error_message(err)
+        requests = [request for _, group in groups for request in group]
+        failed_type = next(iter(requests[index]))
+        self._rejections[failed_type] += 1
+        drop_type = self._rejections[failed_type] >= REPEATED_REJECTIONS
+
+        remaining = []
+        position = 0
+        for label, group in groups:
+            kept = []
+            orphaned = set()
+            slide_dropped = False
+            for request in group:
+                request_type = next(iter(request))
+                if position == index or (drop_type and request_type == failed_type):
+                    self._skip(label, request_type, message if position == index else f"Dropped after repeated '{request_type}' rejections: {message}")
+                    if request_type == 'createSlide':
+                        slide_dropped = True
+                    elif request_type in _CREATE_ELEMENT_REQUESTS and _target_object_id(request):
+                        orphaned.add(_target_object_id(request))
+                elif _target_object_id(request) not in orphaned:
+                    kept.append(request)
+                position += 1
+            # Without its slide none of the group's other requests can apply.
+            if kept and not slide_dropped:
+                remaining.append((label, kept))
+        return remaining
+
+    def _skip(self, label, request_type, message):
+        if request_type:
+            logging.warning(f"Dropping '{request_type}' for slide '{label}' after the API rejected it: {message}")
+        else:
+            logging.warning(f"Skipping slide '{label}' after the API rejected it: {message}")
+        self.skipped.append({'slide': label, 'request': request_type, 'error': message})
+
+    def _execute(self, requests):
+        # 429 and 503 are retried by the Slides write rate limiter.
+        return self.slides_service.presentations().batchUpdate(
+            presentationId=self.presentation_id, body={'requests': requests}
+        ).execute()
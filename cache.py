@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+def content_key(*parts):
+    """Returns a stable SHA-256 key for a tuple of JSON-serializable values."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe in-process cache with least-recently-used and time-to-live eviction."""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value, or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return _stats(self.hits, self.misses, len(self._entries))
+
+
+def _stats(hits, misses, entries):
+    lookups = hits + misses
+    return {'hits': hits, 'misses': misses, 'hit_rate': round(hits / lookups, 3) if lookups else 0.0, 'entries': entries}
+
+
+class DiskCache:
+    """SQLite-backed cache with the same interface and eviction as LRUCache.
+
+    Entries outlive the process (in /tmp, the lifetime of a warm instance) and are
+    shared by every worker process on the instance. Values must be JSON-serializable.
+    """
+
+    def __init__(self, path, max_entries, ttl_seconds):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS entries (
+                       key TEXT PRIMARY KEY,
+                       value_json TEXT NOT NULL,
+                       expires_at REAL NOT NULL,
+                       used_at REAL NOT NULL
+                   )"""
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        """Returns the cached value, or None if it is missing, expired or unreadable."""
+        # Wall-clock time, since entries are shared across processes.
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute('SELECT value_json, expires_at FROM entries WHERE key = ?', (key,)).fetchone()
+                if row and row[1] >= now:
+                    conn.execute('UPDATE entries SET used_at = ? WHERE key = ?', (now, key))
+                elif row:
+                    conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+        except sqlite3.Error as e:
+            logging.warning(f"Cache lookup failed in {self.path}: {e}")
+            row = None
+        hit = bool(row) and row[1] >= now
+        self._count(hit)
+        return json.loads(row[0]) if hit else None
+
+    def set(self, key, value):
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (key, json.dumps(value), now + self.ttl_seconds, now))
+                conn.execute('DELETE FROM entries WHERE expires_at < ?', (now,))
+                conn.execute(
+                    'DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY used_at DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,)
+                )
+        except sqlite3.Error as e:
+            # A failed write only costs a repeat of the work next time.
+            logging.warning(f"Could not write to cache {self.path}: {e}")
+
+    def stats(self):
+        try:
+            with self._connect() as conn:
+                entries = conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        except sqlite3.Error:
+            entries = None
+        with self._lock:
+            return _stats(self.hits, self.misses, entries)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one execution whose result every caller gets.
+
+    Only calls that overlap are joined; once a call finishes, the next one with its
+    key runs again, so results are never served stale from here.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """Returns (result, shared): func()'s result, and whether it came from a call already in flight.
+
+        An exception raised by func() is raised in every caller that joined it.
+        """
+        with self._lock:
+            self.calls += 1
+            future = self._in_flight.get(key)
+            shared = future is not None
+            if shared:
+                self.coalesced += 1
+            else:
+                future = self._in_flight[key] = Future()
+        if shared:
+            return future.result(), True
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._in_flight)}
+
+
+def create_cache(backend, max_entries, ttl_seconds, path=None):
+    """Returns an LRUCache for backend 'memory', a DiskCache at path for 'disk', or None for 'off'."""
+    if backend == 'off':
+        return None
+    if backend == 'disk':
+        return DiskCache(path, max_entries, ttl_seconds)
+    if backend != 'memory':
+        raise ValueError(f"Unknown cache backend '{backend}'; expected 'memory', 'disk' or 'off'.")
+    return LRUCache(max_entries, ttl_seconds)
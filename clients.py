@@ -0,0 +1,199 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import google.auth
+
+import pipeline
+import rate_limiter
+
+# The Vertex AI SDK (seconds to import) and the discovery/httplib2 stack are imported
+# by _load_vertex() and _load_discovery() on first use, so cold starts of actions that
+# never call them, such as CORS preflights and 'get_config', do not pay for them.
+
+SCOPES = ['https://www.googleapis.com/auth/presentations', 'https://www.googleapis.com/auth/drive', 'https://www.googleapis.com/auth/cloud-platform']
+
+# Bearer tokens are short-lived and per user, so cap how many identities a warm
+# instance keeps clients for. The least recently used identity is dropped first.
+MAX_POOLED_IDENTITIES = 32
+
+DEFAULT_IDENTITY = 'default'
+
+_pool = OrderedDict()
+_pool_lock = threading.Lock()
+# vertexai.init() mutates process-wide state, so model construction is serialized.
+_vertex_lock = threading.Lock()
+
+
+def _identity_key(token):
+    return 'bearer:' + hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _get_entry(key, make_credentials):
+    with _pool_lock:
+        entry = _pool.get(key)
+        if entry is None:
+            # 'http' holds each thread's connection for the identity, so evicting the entry frees them all.
+            entry = {'credentials': make_credentials(), 'services': {}, 'models': {}, 'lock': threading.Lock(), 'http': threading.local()}
+            _pool[key] = entry
+            while len(_pool) > MAX_POOLED_IDENTITIES:
+                _pool.popitem(last=False)
+        else:
+            _pool.move_to_end(key)
+        return entry
+
+
+def _user_credentials(token):
+    from google.oauth2 import credentials as oauth2_credentials
+    return oauth2_credentials.Credentials(token, scopes=SCOPES)
+
+
+def _load_discovery():
+    """Returns the discovery build() function and the request class API clients are built with."""
+    from googleapiclient.discovery import build
+    from traced_http import TracedHttpRequest
+    return build, TracedHttpRequest
+
+
+def _load_vertex():
+    """Returns the vertexai module and its GenerativeModel and TextEmbeddingModel classes."""
+    import vertexai
+    from vertexai.generative_models import GenerativeModel
+    from vertexai.language_models import TextEmbeddingModel
+    return vertexai, GenerativeModel, TextEmbeddingModel
+
+
+def get_credentials(auth_header=None):
+    """Returns (identity_key, credentials) for a request, reusing pooled credentials when possible.
+
+    A Bearer token in the Authorization header (as sent by delegated_test_client.py)
+    is used as user-delegated credentials; otherwise the function's default service
+    account credentials are used.
+    """
+    if auth_header and auth_header.startswith('Bearer '):
+        token = auth_header.split(' ')[1]
+        key = _identity_key(token)
+        # The scopes here are for validation and should align with what the client requested.
+        entry = _get_entry(key, lambda: _user_credentials(token))
+    else:
+        key = DEFAULT_IDENTITY
+        entry = _get_entry(key, lambda: google.auth.default(scopes=SCOPES)[0])
+    return key, entry['credentials']
+
+
+def thread_http(key, credentials):
+    """Returns an authorized HTTP object for an identity, owned by the calling thread.
+
+    httplib2 connections are not thread-safe, so each thread gets its own connection
+    instead of sharing the one held by a pooled discovery-built service. Connections
+    live on the identity's pool entry and are released when it is evicted.
+    """
+    thread_state = _get_entry(key, lambda: credentials)['http']
+    http = getattr(thread_state, 'http', None)
+    if http is None:
+        import google_auth_httplib2
+        from googleapiclient.http import build_http
+        # build_http() sets the client library's default socket timeout, so a stalled
+        # connection cannot block a stage, sender or job thread indefinitely.
+        http = thread_state.http = google_auth_httplib2.AuthorizedHttp(credentials, http=build_http())
+    return http
+
+
+class _TracedGenerativeModel:
+    """Wraps a GenerativeModel so generate_content calls go through the Vertex AI rate limiter and their duration and token usage reach the current pipeline."""
+
+    def __init__(self, model):
+        self._model = model
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+    def generate_content(self, *args, stream=False, **kwargs):
+        # A stream is only retried if it fails to start.
+        return rate_limiter.call('vertex', lambda: self._generate_once(args, stream, kwargs))
+
+    def _generate_once(self, args, stream, kwargs):
+        start = time.perf_counter()
+        try:
+            response = self._model.generate_content(*args, stream=stream, **kwargs)
+        except Exception:
+            pipeline.record_gemini_call(None, time.perf_counter() - start, error=True)
+            raise
+        if stream:
+            return self._traced_stream(response, start)
+        pipeline.record_gemini_call(getattr(response, 'usage_metadata', None), time.perf_counter() - start)
+        return response
+
+    def _traced_stream(self, chunks, start):
+        # Token counts arrive with the last chunk.
+        usage_metadata = None
+        try:
+            for chunk in chunks:
+                usage_metadata = getattr(chunk, 'usage_metadata', None) or usage_metadata
+                yield chunk
+        finally:
+            pipeline.record_gemini_call(usage_metadata, time.perf_counter() - start)
+
+
+class _ScheduledEmbeddingModel:
+    """Wraps a TextEmbeddingModel so get_embeddings calls go through the embedding rate limiter."""
+
+    def __init__(self, model):
+        self._model = model
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+    def get_embeddings(self, *args, **kwargs):
+        return rate_limiter.call('vertex_embedding', lambda: self._model.get_embeddings(*args, **kwargs))
+
+
+def get_service(key, credentials, name, version):
+    """Returns a pooled discovery-built API client for an identity obtained from get_credentials()."""
+    entry = _get_entry(key, lambda: credentials)
+    with entry['lock']:
+        service = entry['services'].get((name, version))
+        if service is None:
+            build, request_class = _load_discovery()
+
+            def request_builder(http, *args, **kwargs):
+                return request_class(name, thread_http(key, credentials), *args, **kwargs)
+            # The discovery documents bundled with the client library avoid a
+            # network fetch of the discovery document on every cold build.
+            service = build(name, version, credentials=credentials, requestBuilder=request_builder,
+                            static_discovery=True, cache_discovery=False)
+            entry['services'][(name, version)] = service
+        return service
+
+
+def get_generative_model(key, credentials, model_name, project, location):
+    """Returns a pooled Gemini model whose prediction client is bound to the identity's credentials."""
+    entry = _get_entry(key, lambda: credentials)
+    with _vertex_lock:
+        model = entry['models'].get((model_name, project, location))
+        if model is None:
+            vertexai, GenerativeModel, _ = _load_vertex()
+            vertexai.init(project=project, location=location, credentials=credentials)
+            model = GenerativeModel(model_name)
+            # The prediction client is otherwise created lazily from the global
+            # vertexai config, which a concurrent request may have re-initialized
+            # with different credentials by then. Bind it while we hold the lock.
+            model._prediction_client
+            model = _TracedGenerativeModel(model)
+            entry['models'][(model_name, project, location)] = model
+        return model
+
+
+def get_embedding_model(key, credentials, model_name, project, location):
+    """Returns a pooled Vertex AI text-embedding model created with the identity's credentials."""
+    entry = _get_entry(key, lambda: credentials)
+    with _vertex_lock:
+        model = entry['models'].get(('embedding', model_name, project, location))
+        if model is None:
+            vertexai, _, TextEmbeddingModel = _load_vertex()
+            vertexai.init(project=project, location=location, credentials=credentials)
+            # from_pretrained() builds its endpoint client from the global config immediately.
+            model = _ScheduledEmbeddingModel(TextEmbeddingModel.from_pretrained(model_name))
+            entry['models'][('embedding', model_name, project, location)] = model
+        return model
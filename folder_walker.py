@@ -0,0 +1,71 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from googleapiclient.errors import HttpError
+
+import pipeline
+
+PRESENTATION_MIME_TYPE = 'application/vnd.google-apps.presentation'
+SHORTCUT_MIME_TYPE = 'application/vnd.google-apps.shortcut'
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# The largest page files().list accepts, so big folders need as few round trips as possible.
+PAGE_SIZE = 1000
+# Only what the slide index and shortcut resolution need.
+LIST_FIELDS = 'nextPageToken, files(id, name, mimeType, modifiedTime, version, shortcutDetails(targetId))'
+
+
+def _list_page(drive_service, folder_id, mime_types, page_token):
+    mime_query = ' or '.join(f"mimeType='{mime_type}'" for mime_type in mime_types)
+    return drive_service.files().list(
+        q=f"'{folder_id}' in parents and ({mime_query}) and trashed=false",
+        pageSize=PAGE_SIZE,
+        pageToken=page_token,
+        fields=LIST_FIELDS
+    ).execute()
+
+
+def iter_folder_files(drive_service, folder_id, recursive=True, max_workers=8):
+    """Yields (order_key, file) for every presentation and shortcut in a Drive folder, as pages arrive.
+
+    Every page is followed, and with recursive=True nested folders are walked
+    breadth first with up to max_workers list calls in flight. Files arrive in
+    completion order; sorting by order_key restores the folder's listing order,
+    with each subfolder's contents placed where the subfolder was listed.
+    """
+    mime_types = [PRESENTATION_MIME_TYPE, SHORTCUT_MIME_TYPE] + ([FOLDER_MIME_TYPE] if recursive else [])
+    seen_folders = {folder_id}
+    pending = {}
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='list')
+
+    def submit(listed_folder_id, folder_key, page, page_token):
+        future = executor.submit(pipeline.propagate(_list_page), drive_service, listed_folder_id, mime_types, page_token)
+        pending[future] = (listed_folder_id, folder_key, page)
+
+    try:
+        submit(folder_id, (), 0, None)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                listed_folder_id, folder_key, page = pending.pop(future)
+                try:
+                    response = future.result()
+                except HttpError as err:
+                    # The requested folder must be readable; an unreadable subfolder is only skipped.
+                    if not folder_key:
+                        raise
+                    logging.warning(f"Skipping subfolder {listed_folder_id} that could not be listed: {err}")
+                    continue
+                if response.get('nextPageToken'):
+                    submit(listed_folder_id, folder_key, page + 1, response['nextPageToken'])
+                for position, f in enumerate(response.get('files', [])):
+                    order_key = folder_key + (page, position)
+                    if f.get('mimeType') == FOLDER_MIME_TYPE:
+                        if f.get('id') not in seen_folders:
+                            seen_folders.add(f.get('id'))
+                            submit(f.get('id'), order_key, 0, None)
+                    else:
+                        yield order_key, f
+    finally:
+        # A consumer that stops early must not leave list calls queued.
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,75 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+# Like the slide index, jobs live under /tmp and are local to the instance that ran
+# them. Point JOB_STORE_PATH at a persistent disk for local runs.
+DEFAULT_JOB_STORE_PATH = os.path.join('/tmp', 'jobs.sqlite3')
+# Finished and abandoned jobs are purged after this long. Override with JOB_RETENTION_SECONDS.
+DEFAULT_RETENTION_SECONDS = 24 * 60 * 60
+
+_UPDATABLE_COLUMNS = ('status', 'stage', 'copied', 'total', 'result', 'error')
+
+
+class JobStore:
+    """SQLite-backed store of background deck-build jobs and their progress."""
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get('JOB_STORE_PATH', DEFAULT_JOB_STORE_PATH)
+        self.retention_seconds = int(os.environ.get('JOB_RETENTION_SECONDS', DEFAULT_RETENTION_SECONDS))
+        with self._connect() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                       id TEXT PRIMARY KEY,
+                       status TEXT NOT NULL,
+                       stage TEXT,
+                       copied INTEGER,
+                       total INTEGER,
+                       result TEXT,
+                       error TEXT,
+                       created_at REAL NOT NULL,
+                       updated_at REAL NOT NULL
+                   )"""
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def create(self):
+        """Registers a new queued job and returns its ID."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('DELETE FROM jobs WHERE updated_at < ?', (now - self.retention_seconds,))
+            conn.execute(
+                'INSERT INTO jobs (id, status, stage, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (job_id, 'queued', 'queued', now, now)
+            )
+        return job_id
+
+    def update(self, job_id, **fields):
+        """Updates any of status, stage, copied, total, result (JSON-serializable) and error."""
+        unknown = set(fields) - set(_UPDATABLE_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {sorted(unknown)}")
+        if 'result' in fields:
+            fields['result'] = json.dumps(fields['result'])
+        assignments = ', '.join(f'{column} = ?' for column in fields)
+        with self._connect() as conn:
+            conn.execute(
+                f'UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ?',
+                (*fields.values(), time.time(), job_id)
+            )
+
+    def get(self, job_id):
+        """Returns the job as a dict, or None if it does not exist on this instance."""
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
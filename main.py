@@ -1,19 +1,100 @@
-import functions_framework
+import os
 # Load environment variables from .env file for local development.
-# This should be at the very top of the file.
-from dotenv import load_dotenv
-load_dotenv()
+# This should be at the very top of the file. Deployed functions get their
+# configuration from the environment (Cloud Run sets K_SERVICE), so they skip it.
+if not os.environ.get('K_SERVICE'):
+    from dotenv import load_dotenv
+    load_dotenv()
+import functions_framework
+from flask import Response
 import json
 import logging
-import google.auth
-from google.oauth2 import credentials as oauth2_credentials
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-import vertexai
-from vertexai.generative_models import GenerativeModel
-import os
 import re
-import copy
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+# Vertex AI, the discovery client and numpy are only imported once an action needs
+# them (see clients.py; retrieval and google.api_core are imported where used), which
+# keeps cold starts of preflights, 'get_config' and 'job_status' short.
+import clients
+from cache import LRUCache, SingleFlight, content_key, create_cache
+from batch_executor import BatchExecutor
+import folder_walker
+from job_store import JobStore
+from pipeline import Pipeline, propagate, record_cache_lookup
+import rate_limiter
+from slide_catalog import Deck
+from slide_index import SlideIndex
+from title_index import TitleIndex, DEFAULT_FUZZY_THRESHOLD
+
+# Upper bound on concurrent Drive/Slides reads per request. Override with FETCH_CONCURRENCY.
+DEFAULT_FETCH_CONCURRENCY = 8
+# Decks selected and built at once by 'generate_presentations_batch'. Override with BATCH_CONCURRENCY.
+DEFAULT_BATCH_CONCURRENCY = 4
+
+# Speaker notes for large decks can be split into shards of this many slides that are
+# generated concurrently (NOTES_SHARD_SIZE, or 'shard_size' in the request; 0 disables),
+# with at most NOTES_CONCURRENCY Gemini calls in flight per request.
+DEFAULT_NOTES_SHARD_SIZE = 0
+DEFAULT_NOTES_CONCURRENCY = 4
+
+# Bump whenever _speaker_notes_prompt() changes so cached notes from the old prompt are not reused.
+SPEAKER_NOTES_PROMPT_VERSION = 1
+
+# Generated notes per slide, keyed by the slide's title and content, the model and the prompt version.
+_speaker_notes_cache = LRUCache(
+    max_entries=int(os.environ.get('NOTES_CACHE_MAX_ENTRIES', 2048)),
+    ttl_seconds=int(os.environ.get('NOTES_CACHE_TTL_SECONDS', 24 * 60 * 60))
+)
+
+# Bump whenever the agenda or slide-selection prompt changes so cached answers from the old prompts are not reused.
+GEMINI_RESPONSE_PROMPT_VERSION = 1
+
+# Gemini's agendas and slide selections, keyed by the normalized request, the model, the
+# prompt version and (for selections) the candidate slides offered. GEMINI_CACHE_BACKEND
+# is 'memory' (default), 'disk' (SQLite at GEMINI_CACHE_PATH, shared by every worker
+# process on the instance) or 'off'.
+_gemini_response_cache = create_cache(
+    os.environ.get('GEMINI_CACHE_BACKEND', 'memory'),
+    max_entries=int(os.environ.get('GEMINI_CACHE_MAX_ENTRIES', 512)),
+    ttl_seconds=int(os.environ.get('GEMINI_CACHE_TTL_SECONDS', 6 * 60 * 60)),
+    path=os.environ.get('GEMINI_CACHE_PATH', os.path.join('/tmp', 'gemini_cache.sqlite3'))
+)
+
+# Concurrent identical work on an instance runs once and every caller gets its result:
+# whole requests (same identity and body, e.g. a double-click), folder library loads
+# (same identity and folder, across different requests) and agenda and selection calls
+# to Gemini (same cache key). Their counters are returned as 'single_flight'.
+_request_flights = SingleFlight()
+_library_flights = SingleFlight()
+_gemini_flights = SingleFlight()
+
+# Field masks for Slides API reads, so each read only downloads what its caller uses.
+# Extraction needs placeholder types and text; finding generated slides in a deck being
+# updated needs text and links; copying a slide needs everything _build_copy_requests reads.
+EXTRACT_FIELDS = 'presentationId,slides(objectId,pageElements(shape(placeholder(type),text(textElements(textRun(content))))))'
+GENERATED_SLIDE_FIELDS = 'slides(objectId,pageElements(shape(text(textElements(textRun(content,style(link)))))))'
+COPY_PAGE_FIELDS = (
+    'objectId,pageProperties(pageBackgroundFill),'
+    'pageElements(objectId,size,transform,image(sourceUrl),'
+    'shape(shapeType,placeholder(type),shapeProperties,text(textElements(textRun(content,style)))))'
+)
+# Decks with at least this many selected slides are read in one masked presentations().get
+# rather than one pages().get per slide. Override with PAGE_READS_PER_DECK.
+DEFAULT_PAGE_READS_PER_DECK = 4
+
+# How new decks get their slides (BUILD_MODE, or 'build_mode' in the request): 'reconstruct'
+# recreates every slide element by element; 'duplicate' copies the source deck contributing
+# the most selected slides with Drive, keeps its selected slides in place and deletes the rest,
+# reconstructing only the slides from other decks. Updates always reconstruct.
+BUILD_MODES = ('reconstruct', 'duplicate')
+DEFAULT_BUILD_MODE = 'reconstruct'
+
+# Background deck builds submitted with the 'submit_job' action. Override with JOB_WORKERS.
+# Jobs keep running after the submitting request returns, so the service needs CPU
+# allocated outside of requests, and status polls must reach the same instance.
+_job_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('JOB_WORKERS', 2)), thread_name_prefix='job')
 
 def _get_text_from_element(element):
     """Extracts the text from a PageElement."""
@@ -51,6 +132,1269 @@ def extract_slides_from_presentation(presentation_object, presentation_name):
     return slides_data
 
 
+def _run_concurrently(func, items, max_workers=None):
+    """Applies func to every item on a bounded thread pool and returns the results in input order."""
+    items = list(items)
+    if max_workers is None:
+        max_workers = int(os.environ.get('FETCH_CONCURRENCY', DEFAULT_FETCH_CONCURRENCY))
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(propagate(func), items))
+
+
+def _resolve_shortcut(drive_service, shortcut):
+    """Resolves a Drive shortcut to its target presentation, or returns None if it cannot be used."""
+    target_id = shortcut.get('shortcutDetails', {}).get('targetId')
+    if not target_id:
+        return None
+    try:
+        # For shortcuts, get the target file's metadata to ensure it's a presentation.
+        target_file = drive_service.files().get(fileId=target_id, fields='id, name, mimeType, modifiedTime, version').execute()
+        if target_file.get('mimeType') == 'application/vnd.google-apps.presentation':
+            return {'id': target_file.get('id'), 'name': target_file.get('name'), 'version': target_file.get('version'), 'modified_time': target_file.get('modifiedTime')}
+    except HttpError as err:
+        if err.resp.status == 404:
+            logging.warning(
+                f"Could not resolve shortcut '{shortcut.get('name')}' because the target file (ID: {target_id}) was not found. "
+                f"This usually means the service account does not have permission to view the original file. "
+                f"Please share the original presentation with this function's service account email."
+            )
+        else:
+            logging.warning(f"An unexpected API error occurred while resolving shortcut '{shortcut.get('name')}': {err}")
+    return None
+
+
+def _load_presentation_slides(slides_service, slide_index, pres):
+    """Returns (deck, presentation_obj) for a presentation, reading it from the Slides API only if its revision changed.
+
+    presentation_obj is None when the deck was served from the index, in which case
+    its slides' body text is only read from the index if something asks for it.
+    """
+    rows = slide_index.get(pres.get('id'), pres.get('version'), pres.get('modified_time'))
+    if rows is not None:
+        return Deck(pres.get('id'), pres.get('name'), rows,
+                    load_contents=lambda: slide_index.get_contents(pres.get('id'), pres.get('version'), pres.get('modified_time'))), None
+    presentation_obj = slides_service.presentations().get(presentationId=pres.get('id'), fields=EXTRACT_FIELDS).execute()
+    slides = extract_slides_from_presentation(presentation_obj, pres.get('name'))
+    slide_index.put(pres.get('id'), pres.get('version'), pres.get('modified_time'), pres.get('name'), slides)
+    return Deck.from_records(pres.get('id'), pres.get('name'), slides), presentation_obj
+
+
+def _index_source_pages(presentation_obj, source_pages):
+    """Adds every slide of a fetched presentation to a (presentation_id, slide_id) -> page lookup."""
+    presentation_id = presentation_obj.get('presentationId')
+    for slide in presentation_obj.get('slides', []):
+        source_pages[(presentation_id, slide.get('objectId'))] = slide
+
+
+def _fetch_presentation(slides_service, presentation_id):
+    """Reads the copyable content of every slide in a presentation, or returns None if it cannot be accessed."""
+    try:
+        return slides_service.presentations().get(presentationId=presentation_id, fields=f'presentationId,slides({COPY_PAGE_FIELDS})').execute()
+    except HttpError as err:
+        logging.error(f"Could not read source presentation {presentation_id}: {err}")
+        return None
+
+
+def _fetch_page(slides_service, presentation_id, slide_id):
+    """Reads the copyable content of one slide, or returns None if it cannot be accessed."""
+    try:
+        return slides_service.presentations().pages().get(presentationId=presentation_id, pageObjectId=slide_id, fields=COPY_PAGE_FIELDS).execute()
+    except HttpError as err:
+        logging.error(f"Could not read slide {slide_id} of source presentation {presentation_id}: {err}")
+        return None
+
+
+def _source_slide_url(slide):
+    """The link a copied slide's 'Source:' title points to, which also identifies it when the deck is updated."""
+    return f"https://docs.google.com/presentation/d/{slide['presentation_id']}/edit#slide=id.{slide['slide_id']}"
+
+
+def _generated_slide_source(slide):
+    """Returns the source link of a slide this function generated, or None for any other slide."""
+    # Find any text box that looks like our generated source link.
+    # This is more robust than assuming it's always in a 'TITLE' placeholder.
+    for element in slide.get('pageElements', []):
+        if 'shape' in element and 'text' in element['shape']:
+            element_text = _get_text_from_element(element)
+            if element_text.startswith("Source: "):
+                # Check if any part of the text has a link.
+                link = next((
+                    text_run['textRun']['style']['link'].get('url', '')
+                    for text_run in element['shape']['text'].get('textElements', [])
+                    if text_run.get('textRun', {}).get('style', {}).get('link')
+                ), None)
+                if link is not None:
+                    return link  # Found the source text box, no need to check other elements
+    return None
+
+
+def _reorder_requests(current_order, final_order):
+    """Returns updateSlidesPosition requests that move the slides of final_order, in that order, to the end of the deck.
+
+    Every other slide keeps its relative order. Slides already in place are not
+    moved, so an unchanged deck needs no requests.
+    """
+    final_ids = set(final_order)
+    target_order = [object_id for object_id in current_order if object_id not in final_ids] + list(final_order)
+    current_order = list(current_order)
+    requests = []
+    for index, object_id in enumerate(target_order):
+        if current_order[index] != object_id:
+            # Every earlier position is settled, so the slide is always after index.
+            current_order.remove(object_id)
+            current_order.insert(index, object_id)
+            requests.append({'updateSlidesPosition': {'slideObjectIds': [object_id], 'insertionIndex': index}})
+    return requests
+
+
+def _source_link_requests(slide_to_copy, new_slide_id):
+    """Builds the requests that add a 'Source:' text box linking back to the source slide.
+
+    The link is also how updates recognize generated slides, see _generated_slide_source().
+    """
+    slide_requests = []
+    new_title_shape_id = f"title_for_{new_slide_id}"
+
+    # Manually create a text box to act as the title for the source link.
+    slide_requests.append({
+        'createShape': {
+            'objectId': new_title_shape_id,
+            'shapeType': 'TEXT_BOX',
+            'elementProperties': {
+                'pageObjectId': new_slide_id,
+                'size': {'height': {'magnitude': 500000, 'unit': 'EMU'}, 'width': {'magnitude': 8500000, 'unit': 'EMU'}},
+                'transform': {'scaleX': 1, 'scaleY': 1, 'translateX': 300000, 'translateY': 200000, 'unit': 'EMU'}
+            }
+        }
+    })
+
+    # Add request to set the new title with source information.
+    new_title_text = f"Source: {slide_to_copy['presentation_name']} (Slide {slide_to_copy['slide_number']})"
+    slide_requests.append({
+        'insertText': {'objectId': new_title_shape_id, 'text': new_title_text}
+    })
+
+    # Add a request to make the source text a hyperlink to the original slide.
+    source_slide_url = _source_slide_url(slide_to_copy)
+    slide_requests.append({
+        'updateTextStyle': {
+            'objectId': new_title_shape_id,
+            'style': {
+                'link': {'url': source_slide_url}
+            },
+            'textRange': {'type': 'ALL'},
+            'fields': 'link'
+        }
+    })
+    return slide_requests
+
+
+def _build_copy_requests(slide_to_copy, source_slide_page):
+    """Builds the requests that recreate a source slide, with a linked 'Source:' title, at the end of a deck."""
+    new_slide_id = f"copied_{slide_to_copy['slide_id']}"
+    slide_requests = []
+
+    # By omitting slideLayoutReference, we let the Slides API choose a default layout from the master.
+    # This is robust against custom themes that may not have a 'BLANK' layout.
+    slide_requests.append({'createSlide': {'objectId': new_slide_id}})
+    slide_requests.extend(_source_link_requests(slide_to_copy, new_slide_id))
+
+    # Request to copy the background from the source slide.
+    background_fill = source_slide_page.get('pageProperties', {}).get('pageBackgroundFill')
+    if background_fill:
+        slide_requests.append({
+            'updatePageProperties': {
+                'objectId': new_slide_id,
+                'pageProperties': {'pageBackgroundFill': background_fill},
+                'fields': 'pageBackgroundFill'
+            }
+        })
+
+    # Create requests to copy each element (shapes, text, images).
+    if source_slide_page.get('pageElements'):
+        for element in source_slide_page['pageElements']:
+            if 'placeholder' in element.get('shape', {}):
+                continue # Skip placeholders as they are part of the layout.
+
+            # Project only the fields the requests need instead of deep-copying the element.
+            # Sizes, transforms, shape properties and text styles are shared with the source
+            # page; none of them are modified, only serialized into the request body.
+            new_object_id = f"copied_{element['objectId']}"
+            element_properties = {'pageObjectId': new_slide_id, 'size': element.get('size'), 'transform': element.get('transform')}
+
+            if 'shape' in element:
+                shape = element['shape']
+                # Use .get() to safely access 'shapeType' and provide a default
+                # value if it's missing, preventing a KeyError.
+                slide_requests.append({
+                    'createShape': {
+                        'objectId': new_object_id,
+                        'elementProperties': element_properties,
+                        'shapeType': shape.get('shapeType', 'RECTANGLE')
+                    }
+                })
+
+                # NEW: Add a request to update the shape's properties (fill, outline, etc.) to fix formatting.
+                if 'shapeProperties' in shape:
+                    slide_requests.append({
+                        'updateShapeProperties': {
+                            'objectId': new_object_id,
+                            'shapeProperties': shape['shapeProperties'],
+                            'fields': 'shapeBackgroundFill,outline,shadow'  # Use a specific field mask to avoid read-only fields.
+                        }
+                    })
+
+                if 'text' in shape:
+                    full_text = _get_text_from_element(element)
+                    if full_text:
+                        slide_requests.append({'insertText': {'objectId': new_object_id, 'text': full_text, 'insertionIndex': 0}})
+                        # NEW: Apply the style from the first text run to the entire shape to improve text formatting.
+                        first_style = next((te['textRun']['style'] for te in shape['text'].get('textElements', []) if te.get('textRun') and te['textRun'].get('style')), None)
+                        if first_style:
+                            slide_requests.append({'updateTextStyle': {
+                                'objectId': new_object_id,
+                                'style': first_style,
+                                'textRange': {'type': 'ALL'},
+                                'fields': 'bold,italic,underline,strikethrough,fontFamily,fontSize,foregroundColor,backgroundColor' # Use a specific field mask.
+                            }})
+            elif 'image' in element:
+                # The 'contentUrl' for an image is temporary and not publicly accessible,
+                # which causes the 'createImage' request to fail with a 400 error.
+                # The 'sourceUrl' field, if present, often points to the original,
+                # publicly accessible URL and is more reliable for copying.
+                image_url = element['image'].get('sourceUrl')
+
+                if image_url:
+                    slide_requests.append({'createImage': {
+                        'objectId': new_object_id,
+                        'url': image_url,
+                        'elementProperties': element_properties
+                    }})
+                else:
+                    # If no public sourceUrl is available (e.g., for copy-pasted images),
+                    # log a warning and skip this element to prevent the function from crashing.
+                    logging.warning(f"Skipping image element '{new_object_id}' from source slide '{slide_to_copy['slide_id']}' because it does not have a public 'sourceUrl'. This is a known limitation when copying pasted images via the Slides API.")
+    return slide_requests
+
+
+def _speaker_notes_prompt(slides_data):
+    """Builds the speaker-notes prompt for a list of slide records with 'title' and 'content'."""
+    slides_text = '\n\n'.join([f"Slide Title: {slide.get('title', '')}\nSlide Content: {slide.get('content', '')}" for slide in slides_data])
+    
+    return f"""You are a public speaking coach. A user has a presentation with the following slides. Your task is to generate concise and conversational speaker notes for each slide. Focus on the key takeaways and provide guidance on how to present the information effectively. Use a friendly and encouraging tone.
+
+                        Slides:
+                        {slides_text}
+                        
+                        Please format your response as a Markdown document with a top-level heading for each slide, followed by bullet points for the notes."""
+
+
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class _NotesSplitter:
+    """Splits speaker-notes Markdown, possibly streamed in chunks, into one section per slide.
+
+    Sections start at the heading level used by the first heading (normally '# ');
+    any preamble before it stays with the first section.
+    """
+
+    def __init__(self):
+        self._partial_line = ''
+        self._section = []
+        self._section_has_heading = False
+        self._heading_marker = None
+
+    def feed(self, text):
+        """Consumes more text and returns the sections it completed."""
+        completed = []
+        *lines, self._partial_line = (self._partial_line + text).split('\n')
+        for line in lines:
+            heading = re.match(r'(#+)\s', line)
+            if heading:
+                self._heading_marker = self._heading_marker or heading.group(1)
+                if heading.group(1) == self._heading_marker:
+                    if self._section_has_heading:
+                        completed.append('\n'.join(self._section).strip())
+                        self._section = []
+                    self._section_has_heading = True
+            self._section.append(line)
+        return completed
+
+    def close(self):
+        """Returns the final section, if any text remains."""
+        self._section.append(self._partial_line)
+        last = '\n'.join(self._section).strip()
+        return [last] if last else []
+
+
+def _split_notes(markdown):
+    splitter = _NotesSplitter()
+    return splitter.feed(markdown) + splitter.close()
+
+
+def _read_deck_contents(slides_service, drive_service, slide_index, presentation_id):
+    """Reads a deck the slide index does not hold, indexes it and returns its {slide_id: body text}."""
+    f = drive_service.files().get(fileId=presentation_id, fields='id, name, version, modifiedTime').execute()
+    pres = {'id': f.get('id'), 'name': f.get('name'), 'version': f.get('version'), 'modified_time': f.get('modifiedTime')}
+    deck, _ = _load_presentation_slides(slides_service, slide_index, pres)
+    return {slide.slide_id: slide.content for slide in deck.slides}
+
+
+def _resolve_slide_contents(slides_data, identity, credentials):
+    """Fills in the body text of slide references from a generated deck's selected_slides, which leave it out.
+
+    The text comes from this instance's slide index, and decks it does not hold
+    (such as on a cold instance) are read and indexed. Returns (slides_data, None),
+    or (None, (error_message, status)) if a deck cannot be read.
+    """
+    presentation_ids = list(dict.fromkeys(s['presentation_id'] for s in slides_data if 'content' not in s and s.get('presentation_id')))
+    if not presentation_ids:
+        return slides_data, None
+    slide_index = SlideIndex()
+    contents = {presentation_id: slide_index.get_contents(presentation_id) for presentation_id in presentation_ids}
+    unindexed = [presentation_id for presentation_id, deck_contents in contents.items() if deck_contents is None]
+    if unindexed:
+        slides_service = clients.get_service(identity, credentials, 'slides', 'v1')
+        drive_service = clients.get_service(identity, credentials, 'drive', 'v3')
+
+        def _read(presentation_id):
+            try:
+                return _read_deck_contents(slides_service, drive_service, slide_index, presentation_id)
+            except HttpError as err:
+                logging.error(f"Could not read presentation {presentation_id} for speaker notes: {err}")
+                return None
+
+        for presentation_id, deck_contents in zip(unindexed, _run_concurrently(_read, unindexed)):
+            if deck_contents is None:
+                return None, (f"Error: Could not read presentation {presentation_id} to get the text of its slides.", 403)
+            contents[presentation_id] = deck_contents
+    return [
+        {**s, 'content': contents[s['presentation_id']].get(s.get('slide_id'), '')} if 'content' not in s and s.get('presentation_id') else s
+        for s in slides_data
+    ], None
+
+
+def _speaker_notes_cache_key(slide, model_name):
+    return content_key(slide.get('title', ''), slide.get('content', ''), model_name, SPEAKER_NOTES_PROMPT_VERSION)
+
+
+def _notes_shards(indices, shard_size):
+    """Splits the slide indices that need notes into shards of at most shard_size slides."""
+    if not indices:
+        return []
+    if not shard_size or shard_size <= 0:
+        return [indices]
+    return [indices[start:start + shard_size] for start in range(0, len(indices), shard_size)]
+
+
+def _merge_notes(notes, keys, indices, generated):
+    """Places the Markdown generated for the slides at indices into notes, caching each slide's section."""
+    sections = _split_notes(generated)
+    if len(sections) == len(indices):
+        for i, section in zip(indices, sections):
+            notes[i] = section
+            _speaker_notes_cache.set(keys[i], section)
+    else:
+        # The sections cannot be attributed to slides reliably, so nothing is cached
+        # and the generated notes are kept together where the first of those slides was.
+        logging.warning(f"Expected notes for {len(indices)} slides but Gemini returned {len(sections)} sections; not caching them.")
+        notes[indices[0]] = generated.strip()
+        for i in indices[1:]:
+            notes[i] = ''
+
+
+def _generate_speaker_notes(gemini_model, model_name, slides_data, shard_size=0, concurrency=None):
+    """Returns (notes_markdown, cached_count), asking Gemini only about slides without cached notes.
+
+    With a shard_size, the slides are split into shards that are generated concurrently
+    and reassembled in slide order.
+    """
+    keys = [_speaker_notes_cache_key(slide, model_name) for slide in slides_data]
+    notes = [_speaker_notes_cache.get(key) for key in keys]
+    missing = [i for i, section in enumerate(notes) if section is None]
+    shards = _notes_shards(missing, shard_size)
+    generated = _run_concurrently(
+        lambda shard: gemini_model.generate_content(_speaker_notes_prompt([slides_data[i] for i in shard])).text,
+        shards,
+        max_workers=concurrency
+    )
+    for shard, text in zip(shards, generated):
+        _merge_notes(notes, keys, shard, text)
+    return '\n\n'.join(section for section in notes if section), len(slides_data) - len(missing)
+
+
+def _stream_speaker_notes(gemini_model, model_name, slides_data, shard_size=0, concurrency=None):
+    """Yields speaker notes as server-sent events, one 'slide' event per slide in deck order.
+
+    Cached notes are sent immediately; the rest are streamed from Gemini as each
+    slide's section completes, or, when sharded, as each concurrent shard finishes.
+    A final 'done' event carries the complete Markdown, or an 'error' event is
+    sent if generation fails.
+    """
+    # Send something right away so the client sees the response start before Gemini does.
+    yield ': generating speaker notes\n\n'
+    keys = [_speaker_notes_cache_key(slide, model_name) for slide in slides_data]
+    notes = [_speaker_notes_cache.get(key) for key in keys]
+    missing = [i for i, section in enumerate(notes) if section is None]
+    next_index = 0
+
+    def flush_ready():
+        # Emit every slide, in order, whose notes are known and not yet sent.
+        nonlocal next_index
+        while next_index < len(notes) and notes[next_index] is not None:
+            yield _sse_event('slide', {'index': next_index, 'notes': notes[next_index]})
+            next_index += 1
+
+    try:
+        yield from flush_ready()
+        shards = _notes_shards(missing, shard_size)
+        if len(shards) > 1:
+            workers = concurrency or int(os.environ.get('NOTES_CONCURRENCY', DEFAULT_NOTES_CONCURRENCY))
+            with ThreadPoolExecutor(max_workers=min(workers, len(shards))) as executor:
+                futures = {
+                    executor.submit(propagate(gemini_model.generate_content), _speaker_notes_prompt([slides_data[i] for i in shard])): shard
+                    for shard in shards
+                }
+                for future in as_completed(futures):
+                    _merge_notes(notes, keys, futures[future], future.result().text)
+                    yield from flush_ready()
+        elif missing:
+            splitter = _NotesSplitter()
+            sections = []
+            def assign(completed):
+                for section in completed:
+                    if len(sections) < len(missing):
+                        notes[missing[len(sections)]] = section
+                    else:
+                        # More sections than slides; keep the extra text with the last slide.
+                        notes[missing[-1]] += '\n\n' + section
+                    sections.append(section)
+            for chunk in gemini_model.generate_content(_speaker_notes_prompt([slides_data[i] for i in missing]), stream=True):
+                assign(splitter.feed(chunk.text))
+                yield from flush_ready()
+            assign(splitter.close())
+            if len(sections) == len(missing):
+                for i in missing:
+                    _speaker_notes_cache.set(keys[i], notes[i])
+            else:
+                logging.warning(f"Expected notes for {len(missing)} slides but Gemini returned {len(sections)} sections; not caching them.")
+                for i in missing:
+                    if notes[i] is None:
+                        notes[i] = ''
+            yield from flush_ready()
+        yield _sse_event('done', {'notes': '\n\n'.join(section for section in notes if section)})
+    except Exception as e:
+        # The HTTP status has already been sent, so errors are reported in-stream.
+        logging.error(f"Speaker notes stream failed: {e}", exc_info=True)
+        yield _sse_event('error', {'message': str(e)})
+
+
+def _get_embedder(identity, credentials, project_id, region):
+    """Returns the embedding backend selected by RETRIEVAL_BACKEND ('hashed' or 'vertex') for slide pre-retrieval."""
+    import retrieval
+    if os.environ.get('RETRIEVAL_BACKEND', 'hashed') == 'vertex':
+        model_name = os.environ.get('EMBEDDING_MODEL_NAME', 'text-embedding-004')
+        return retrieval.VertexEmbedder(clients.get_embedding_model(identity, credentials, model_name, project_id, region), model_name)
+    return retrieval.HashingEmbedder()
+
+
+def _deck_spec(request_json):
+    """Reads the fields of one deck to build from a request.
+
+    Returns (deck, None), or (None, (error_message, status)) if the request is invalid.
+    """
+    customer_request = request_json.get('customer_request')
+    duration = request_json.get('duration')
+    slides_to_update_url = request_json.get('slides_to_update')
+
+    # Construct the presentation title by combining slide_title and meeting_date
+    slide_title = request_json.get('slide_title')
+    meeting_date = request_json.get('meeting_date')
+    title_base = slide_title or customer_request
+    if meeting_date:
+        presentation_title = f"{title_base} ({meeting_date})"
+    else:
+        presentation_title = title_base
+
+    build_mode = request_json.get('build_mode') or os.environ.get('BUILD_MODE', DEFAULT_BUILD_MODE)
+    if build_mode not in BUILD_MODES:
+        return None, (f"Error: Unknown 'build_mode' '{build_mode}'; expected one of {', '.join(BUILD_MODES)}.", 400)
+
+    presentation_id = None
+    if slides_to_update_url:
+        presentation_id_match = re.search(r'/d/([a-zA-Z0-9-_]+)', slides_to_update_url)
+        if not presentation_id_match:
+            return None, ("Error: Invalid 'slides_to_update' URL format.", 400)
+        presentation_id = presentation_id_match.group(1)
+
+    return {
+        'customer_request': customer_request,
+        'duration': duration,
+        'presentation_title': presentation_title,
+        'slides_to_update_url': slides_to_update_url,
+        'presentation_id': presentation_id,
+        'user_account': request_json.get('user_account'),
+        # 'response_cache': false asks Gemini again instead of reusing a cached agenda or selection.
+        'use_response_cache': request_json.get('response_cache', True) is not False,
+        # Recreate every generated slide instead of keeping the ones still selected.
+        'full_refresh': bool(request_json.get('full_refresh')),
+        'build_mode': build_mode
+    }, None
+
+
+def _normalize_request_text(text):
+    """Folds case and whitespace, so retries that only differ in those share cached Gemini answers."""
+    return ' '.join(str(text or '').casefold().split())
+
+
+def _gemini_cache_key(kind, *parts):
+    return content_key(kind, os.environ.get('GEMINI_MODEL_NAME', 'gemini-2.5-pro'), GEMINI_RESPONSE_PROMPT_VERSION, *parts)
+
+
+def _cached_gemini_answer(kind, key, deck):
+    """Returns a cached Gemini answer, or None if there is none or the request opted out."""
+    if _gemini_response_cache is None or not deck['use_response_cache']:
+        return None
+    answer = _gemini_response_cache.get(key)
+    record_cache_lookup(f'gemini_{kind}', answer is not None)
+    return answer
+
+
+def _cache_gemini_answer(key, answer):
+    # Answers are stored even when the request skipped the lookup, so a retry for a fresh answer refreshes the cache.
+    if _gemini_response_cache is not None:
+        _gemini_response_cache.set(key, answer)
+
+
+def _coalesced(flights, name, key, func):
+    """Runs func() through a SingleFlight, recording on the current pipeline whether it joined a call in flight."""
+    result, shared = flights.do(key, func)
+    record_cache_lookup(f'coalesced_{name}', shared)
+    return result
+
+
+def _single_flight_stats():
+    return {'requests': _request_flights.stats(), 'libraries': _library_flights.stats(), 'gemini': _gemini_flights.stats()}
+
+
+def _generate_agenda(gemini_model, deck):
+    key = _gemini_cache_key('agenda', _normalize_request_text(deck['customer_request']))
+    agenda = _cached_gemini_answer('agenda', key, deck)
+    if agenda is None:
+        agenda_prompt = f"Generate a concise, bulleted list for an agenda for a presentation about the following topic: '{deck['customer_request']}'. Do not add any introductory text, just the bullet points."
+        agenda = _coalesced(_gemini_flights, 'gemini', key, lambda: gemini_model.generate_content(agenda_prompt).text)
+        _cache_gemini_answer(key, agenda)
+    return agenda
+
+
+def _start_deck_stages(pipeline, slides_service, gemini_model, deck):
+    """Starts the background stages that need nothing but the request itself."""
+    # The agenda depends only on the request and the deck being updated is read-only
+    # here, so both overlap with listing, deck reads and slide selection.
+    if deck['slides_to_update_url']:
+        pipeline.start('read_existing_presentation', lambda: slides_service.presentations().get(presentationId=deck['presentation_id'], fields=GENERATED_SLIDE_FIELDS).execute())
+    else:
+        pipeline.start('agenda', lambda: _generate_agenda(gemini_model, deck))
+
+
+def _ignore_progress(stage, **progress):
+    pass
+
+
+def _load_library(slides_service, drive_service, folder_id, pipeline, report=_ignore_progress):
+    """Lists the source folder and its subfolders and extracts the titled slides of every presentation in them.
+
+    Returns (library, None), or (None, (error_message, status)) if the folder holds no usable slides.
+    """
+    def _to_presentation(f):
+        if f.get('mimeType') == 'application/vnd.google-apps.presentation':
+            return {'id': f.get('id'), 'name': f.get('name'), 'version': f.get('version'), 'modified_time': f.get('modifiedTime')}
+        # Shortcuts are resolved alongside the deck reads; unresolvable shortcuts come back as None.
+        return _resolve_shortcut(drive_service, f)
+
+    # Only re-read decks whose Drive revision changed since they were last indexed.
+    slide_index = SlideIndex()
+
+    def _load(f):
+        pres = _to_presentation(f)
+        return (pres, _load_presentation_slides(slides_service, slide_index, pres)) if pres else None
+
+    # Decks are read as soon as their listing page arrives, while the rest of the
+    # folder (and its subfolders, unless FOLDER_RECURSIVE=0) is still being listed.
+    fetch_concurrency = int(os.environ.get('FETCH_CONCURRENCY', DEFAULT_FETCH_CONCURRENCY))
+    recursive = os.environ.get('FOLDER_RECURSIVE', '1') != '0'
+    with pipeline.stage('list_and_load_decks'):
+        with ThreadPoolExecutor(max_workers=fetch_concurrency) as executor:
+            futures = []
+            for order_key, f in folder_walker.iter_folder_files(drive_service, folder_id, recursive, fetch_concurrency):
+                if not futures:
+                    report('loading_decks')
+                futures.append((order_key, executor.submit(propagate(_load), f)))
+            results = sorted(((order_key, future.result()) for order_key, future in futures), key=lambda item: item[0])
+
+    # A deck reachable through several shortcuts or subfolders is only used once.
+    presentations_to_process = []
+    loaded = []
+    seen_ids = set()
+    for _, result in results:
+        if result and result[0]['id'] not in seen_ids:
+            seen_ids.add(result[0]['id'])
+            presentations_to_process.append(result[0])
+            loaded.append(result[1])
+
+    if not presentations_to_process:
+        return None, (f"Error: No presentations or valid shortcuts to presentations found in folder '{folder_id}'.", 400)
+
+    index_hits = sum(1 for _, presentation_obj in loaded if presentation_obj is None)
+    index_misses = len(loaded) - index_hits
+    slide_count = sum(len(deck.slides) for deck, _ in loaded)
+    logging.info(f"Slide index: {index_hits} hits, {index_misses} misses across {len(presentations_to_process)} presentations.")
+    
+    if not slide_count:
+        return None, ("Error: Could not find any slides with titles in the provided presentations.", 400)
+
+    return {
+        # Slide records are slide_catalog.SlideRecord objects, which share their deck's metadata.
+        'decks': [(pres, deck.slides) for pres, (deck, _) in zip(presentations_to_process, loaded)],
+        'slide_count': slide_count,
+        # Full pages of selected slides, filled in by _fetch_selected_pages().
+        'pages': {},
+        # Retrieval vectors per embedding backend, filled in by _library_vectors().
+        'vectors': {},
+        'vectors_lock': threading.Lock(),
+        'index_hits': index_hits,
+        'index_misses': index_misses
+    }, None
+
+
+def _load_shared_library(identity, slides_service, drive_service, folder_id, pipeline, report=_ignore_progress):
+    """Like _load_library(), but joins a load of the same folder for the same identity that is already in flight.
+
+    The joined library, including the pages fetched into it later, is shared with
+    the other request; its contents are the same for both.
+    """
+    key = (identity, folder_id, os.environ.get('FOLDER_RECURSIVE', '1'))
+    return _coalesced(_library_flights, 'library', key, lambda: _load_library(slides_service, drive_service, folder_id, pipeline, report))
+
+
+def _library_vectors(library, embedder):
+    """Embeds a library once per embedding backend, however many decks are selected from it."""
+    import retrieval
+    with library['vectors_lock']:
+        vectors = library['vectors'].get(embedder.name)
+        if vectors is None:
+            vectors = library['vectors'][embedder.name] = retrieval.LibraryVectors(library['decks'], embedder)
+        return vectors
+
+
+def _select_deck_slides(gemini_model, library, deck, embedder, pipeline):
+    """Asks Gemini for the slides of one deck and matches its answer back to library slides.
+
+    Returns (selected_slides, title_index, None), or (None, None, (error_message, status))
+    if Gemini's answer cannot be parsed.
+    """
+    import retrieval
+
+    # Narrow the library to the slides most similar to the request so the
+    # selection prompt does not grow with the size of the library.
+    with pipeline.stage('retrieval'):
+        top_k = int(os.environ.get('RETRIEVAL_TOP_K', retrieval.DEFAULT_TOP_K))
+        candidate_slides = retrieval.select_candidates(
+            deck['customer_request'],
+            library['decks'],
+            top_k,
+            vectors=_library_vectors(library, embedder) if 0 < top_k < library['slide_count'] else None
+        )
+
+    # 3. Use Gemini to select relevant slides
+    prompt = f"""You are a presentation strategist. A user wants to create a presentation deck. Their request is: "{deck['customer_request']}".
+                 You have a library of all available slide titles. Select the most relevant titles to create a coherent presentation for a {deck['duration']} presentation. 
+                 The user has provided an agenda for the new slide deck in their request. Think carefully about your selected slides to ensure they match the agenda provided by the user in their request.
+                 Available Slides: {json.dumps([s['title'] for s in candidate_slides])}
+                 Return a JSON object with a single key "selected_slides" which is an array of the selected slide titles in the optimal order."""
+    # The candidate titles stand in for the library: decks can change without invalidating
+    # a selection as long as the prompt would offer the same slides.
+    cache_key = _gemini_cache_key(
+        'selection',
+        _normalize_request_text(deck['customer_request']),
+        _normalize_request_text(deck['duration']),
+        content_key([s['title'] for s in candidate_slides])
+    )
+    cached_titles = _cached_gemini_answer('selection', cache_key, deck)
+    if cached_titles is not None:
+        selected_titles = cached_titles
+    else:
+        with pipeline.stage('select_slides'):
+            response_text = _coalesced(_gemini_flights, 'gemini', cache_key, lambda: gemini_model.generate_content(prompt).text)
+
+        try:
+            json_match = re.search(r'```json\s*({[\s\S]*?})\s*```', response_text)
+            json_str = json_match.group(1) if json_match else response_text.strip()
+            selected_titles = json.loads(json_str).get('selected_slides', [])
+        except (json.JSONDecodeError, AttributeError):
+            return None, None, (f"Error: Gemini API returned a non-JSON response: '{response_text}'.", 500)
+        _cache_gemini_answer(cache_key, selected_titles)
+
+    # Each title consumes the next library slide with that (normalized) title, so
+    # repeated titles map to distinct slides. Paraphrased titles fall back to a
+    # trigram match unless TITLE_FUZZY_MATCH=0.
+    title_index = TitleIndex(
+        candidate_slides,
+        fuzzy=os.environ.get('TITLE_FUZZY_MATCH', '1') != '0',
+        fuzzy_threshold=float(os.environ.get('TITLE_FUZZY_THRESHOLD', DEFAULT_FUZZY_THRESHOLD))
+    )
+    ordered_selected_slides = [slide for slide in map(title_index.take, selected_titles) if slide]
+    logging.info(f"Matched {len(ordered_selected_slides)} of {len(selected_titles)} selected titles ({title_index.fuzzy_matches} fuzzy, {len(title_index.unmatched)} unmatched).")
+    if title_index.unmatched:
+        logging.warning(f"Gemini selected titles that match no slide: {title_index.unmatched}")
+    return ordered_selected_slides, title_index, None
+
+
+def _copy_presentation(slides_service, drive_service, source_id, title):
+    """Copies a deck with Drive and returns the copy's ID and slide object IDs, which match the source's."""
+    # Without explicit parents the copy would land in the source library folder.
+    copied = drive_service.files().copy(fileId=source_id, body={'name': title, 'parents': ['root']}, fields='id').execute()
+    return slides_service.presentations().get(presentationId=copied['id'], fields='presentationId,slides(objectId)').execute()
+
+
+def _start_create_presentation(pipeline, slides_service, drive_service, deck, plan):
+    # Creating the new deck only once the selection succeeded avoids leaving empty
+    # decks behind on errors; it overlaps with reading the selected slides' pages.
+    if deck['slides_to_update_url']:
+        return
+    if plan['base_deck']:
+        pipeline.start('create_presentation', lambda: _copy_presentation(slides_service, drive_service, plan['base_deck'], deck['presentation_title']))
+    else:
+        pipeline.start('create_presentation', lambda: slides_service.presentations().create(body={'title': deck['presentation_title']}).execute())
+
+
+def _fetch_selected_pages(slides_service, library, selected_slides):
+    """Reads the full pages of selected slides that have not been read yet.
+
+    Extraction only downloads titles and body text, so this is the only read of
+    page elements, and it is limited to the slides that will actually be copied.
+    """
+    source_pages = library['pages']
+    missing_by_deck = {}
+    for s in selected_slides:
+        if (s['presentation_id'], s['slide_id']) not in source_pages:
+            missing_by_deck.setdefault(s['presentation_id'], []).append(s['slide_id'])
+
+    # Decks contributing many slides are read once; the rest one page at a time.
+    deck_threshold = int(os.environ.get('PAGE_READS_PER_DECK', DEFAULT_PAGE_READS_PER_DECK))
+    reads = []
+    for presentation_id, slide_ids in missing_by_deck.items():
+        unique_slide_ids = list(dict.fromkeys(slide_ids))
+        if len(unique_slide_ids) >= deck_threshold:
+            reads.append((presentation_id, None))
+        else:
+            reads.extend((presentation_id, slide_id) for slide_id in unique_slide_ids)
+
+    def _read(item):
+        presentation_id, slide_id = item
+        if slide_id is None:
+            return _fetch_presentation(slides_service, presentation_id)
+        page = _fetch_page(slides_service, presentation_id, slide_id)
+        return {'presentationId': presentation_id, 'slides': [page]} if page else None
+
+    for presentation_obj in _run_concurrently(_read, reads):
+        if presentation_obj:
+            _index_source_pages(presentation_obj, source_pages)
+
+
+def _plan_deck(pipeline, deck, ordered_selected_slides):
+    """Works out which selected slides need copying into the deck.
+
+    A new deck copies every selected slide, or in duplicate mode only those outside
+    the base deck it is copied from (see BUILD_MODES). When updating, generated slides whose
+    source is still selected are kept, generated slides that were dropped are
+    deleted, and only newly selected slides are copied. Returns (plan, None), or
+    (None, (error_message, status)) if the deck to update cannot be read.
+    """
+    if not deck['slides_to_update_url']:
+        if deck['build_mode'] != 'duplicate' or not ordered_selected_slides:
+            return {'copy': ordered_selected_slides, 'keep': [], 'base_deck': None, 'delete': [], 'existing_order': None, 'final': None}, None
+
+        # Ties go to the deck whose slide is selected first.
+        base_deck = Counter(s['presentation_id'] for s in ordered_selected_slides).most_common(1)[0][0]
+        slides_to_copy = []
+        # The base deck's selected slides keep their object IDs in its copy. TitleIndex.take()
+        # consumes each library slide, so no slide is selected twice.
+        slides_to_keep = []
+        final = []
+        for slide in ordered_selected_slides:
+            if slide['presentation_id'] != base_deck:
+                slides_to_copy.append(slide)
+                final.append((f"copied_{slide['slide_id']}", slide['slide_id']))
+            else:
+                slides_to_keep.append(slide)
+                final.append((slide['slide_id'], slide['slide_id']))
+        logging.info(f"Keeping {len(slides_to_keep)} slides of presentation {base_deck} in its copy and reconstructing {len(slides_to_copy)}.")
+        return {'copy': slides_to_copy, 'keep': slides_to_keep, 'base_deck': base_deck, 'delete': [], 'existing_order': None, 'final': final}, None
+
+    # --- UPDATE EXISTING PRESENTATION FLOW ---
+    try:
+        existing_presentation = pipeline.result('read_existing_presentation')
+    except HttpError as err:
+        return None, (f"Error: Could not access presentation to update. {err}", 403)
+
+    # Identify script-generated slides by the source link they embed.
+    # We skip the first two slides (Title and Agenda) to preserve them.
+    existing_order = []
+    generated = {}
+    for i, slide in enumerate(existing_presentation.get('slides', [])):
+        existing_order.append(slide['objectId'])
+        if i < 2:  # Skip the first two slides (Title and Agenda)
+            continue
+        source = _generated_slide_source(slide)
+        if source is not None:
+            generated.setdefault(source, []).append(slide['objectId'])
+
+    slides_to_copy = []
+    # (object ID, source slide ID if it is copied in this run) for every generated slide, in final order.
+    final = []
+    for slide in ordered_selected_slides:
+        kept = generated.get(_source_slide_url(slide))
+        if kept and not deck['full_refresh']:
+            final.append((kept.pop(0), None))
+        else:
+            slides_to_copy.append(slide)
+            final.append((f"copied_{slide['slide_id']}", slide['slide_id']))
+    slides_to_delete = [object_id for object_ids in generated.values() for object_id in object_ids]
+    logging.info(f"Update keeps {len(final) - len(slides_to_copy)} generated slides, deletes {len(slides_to_delete)} and copies {len(slides_to_copy)}.")
+    return {'copy': slides_to_copy, 'keep': [], 'base_deck': None, 'delete': slides_to_delete, 'existing_order': existing_order, 'final': final}, None
+
+
+def _add_kept_slide_requests(batch, plan, new_presentation):
+    """Adds the requests that turn the base deck's selected slides in its copy into generated slides.
+
+    Each slide gets a linked 'Source:' text box. Returns the (object ID, batch group label)
+    of the kept slides in deck order once the batch is sent, for _reorder_requests() to
+    compare with plan['final'].
+    """
+    for slide in plan['keep']:
+        batch.add(slide['slide_id'], _source_link_requests(slide, slide['slide_id']))
+    kept = {slide['slide_id'] for slide in plan['keep']}
+    return [(page['objectId'], page['objectId']) for page in new_presentation.get('slides', []) if page['objectId'] in kept]
+
+
+def _build_deck(slides_service, drive_service, pipeline, deck, library, plan, ordered_selected_slides, title_index, report):
+    """Creates or updates one presentation from a plan made by _plan_deck(), whose pages are already fetched.
+
+    Returns (response_data, 200).
+    """
+    presentation_id = deck['presentation_id']
+    slides_to_update_url = deck['slides_to_update_url']
+    source_pages = library['pages']
+    slides_to_copy = plan['copy']
+    requests = []
+    # Slides the new presentation starts with but does not keep, sent as their own group
+    # so a rejected title or agenda slide does not keep them in the deck.
+    removed_slides = []
+    # (object ID, batch group label or None) of the deck's slides once the batch is sent,
+    # in deck order and in final order, when slides need moving afterwards.
+    current_slides = None
+    final_slides = None
+
+    if slides_to_update_url:
+        for slide_id in plan['delete']:
+            requests.append({'deleteObject': {'objectId': slide_id}})
+
+    else:
+        # --- CREATE NEW PRESENTATION FLOW ---
+        new_presentation = pipeline.result('create_presentation')
+        presentation_id = new_presentation.get('presentationId')
+
+        if plan['base_deck']:
+            # The copy of the base deck only keeps its selected slides.
+            selected_ids = {slide['slide_id'] for slide in plan['keep']}
+            for slide in new_presentation.get('slides', []):
+                if slide['objectId'] not in selected_ids:
+                    removed_slides.append({'deleteObject': {'objectId': slide['objectId']}})
+        else:
+            # Delete the default slide that comes with a new presentation.
+            removed_slides.append({'deleteObject': {'objectId': new_presentation.get('slides')[0]['objectId']}})
+
+        # Create a new, clean title slide from a predefined layout.
+        title_slide_id = 'title_slide_01'
+        title_shape_id = 'title_shape_01'
+        subtitle_shape_id = 'subtitle_shape_01'
+        requests.extend([
+            {'createSlide': {
+                'objectId': title_slide_id,
+                'insertionIndex': 0,
+                'slideLayoutReference': {'predefinedLayout': 'TITLE'},
+                'placeholderIdMappings': [
+                    {'layoutPlaceholder': {'type': 'CENTERED_TITLE'}, 'objectId': title_shape_id},
+                    {'layoutPlaceholder': {'type': 'SUBTITLE'}, 'objectId': subtitle_shape_id}
+                ]
+            }},
+            {'insertText': {'objectId': title_shape_id, 'text': deck['presentation_title']}},
+            {'insertText': {'objectId': subtitle_shape_id, 'text': 'Generated by Gemini Code Assist'}}
+        ])
+        
+        # Create the Agenda slide, including the content generated in the background, in one step.
+        agenda_content = pipeline.result('agenda')
+        agenda_slide_id = 'agenda_slide_01'
+        title_shape_id = 'agenda_title_shape_01'
+        body_shape_id = 'agenda_body_shape_01'
+        requests.extend([
+            {'createSlide': {
+                'objectId': agenda_slide_id,
+                'insertionIndex': 1, # Insert after the title slide
+                'slideLayoutReference': {'predefinedLayout': 'TITLE_AND_BODY'},
+                'placeholderIdMappings': [
+                    {'layoutPlaceholder': {'type': 'TITLE'}, 'objectId': title_shape_id},
+                    {'layoutPlaceholder': {'type': 'BODY'}, 'objectId': body_shape_id}
+                ]
+            }},
+            {'insertText': {'objectId': title_shape_id, 'text': 'Agenda'}},
+            {'insertText': {'objectId': body_shape_id, 'text': agenda_content}}
+        ])
+
+    # Requests are sent in ordered, size-capped chunks along slide boundaries
+    # while the remaining slides are still being built.
+    header_label = 'deleted_slides' if slides_to_update_url else 'title_and_agenda'
+    copied_count = 0
+
+    total = len(slides_to_copy) + len(plan['keep'])
+    report('building_presentation', copied=0, total=total)
+
+    def on_sent(labels):
+        nonlocal copied_count
+        copied_count += sum(1 for label in labels if label not in (header_label, 'removed_slides'))
+        report('building_presentation', copied=copied_count, total=total)
+
+    batch = BatchExecutor(slides_service, presentation_id, on_sent=on_sent)
+    if removed_slides:
+        batch.add('removed_slides', removed_slides)
+    batch.add(header_label, requests)
+
+    if plan['base_deck']:
+        with pipeline.stage('keep_base_slides'):
+            current_slides = [(title_slide_id, header_label), (agenda_slide_id, header_label)] + _add_kept_slide_requests(batch, plan, new_presentation)
+            final_slides = plan['final']
+
+    with pipeline.stage('build_and_send_requests'):
+        # This logic is now common to both create and update flows.
+        # It constructs requests to add the newly selected slides.
+        # In an update, they will be appended. In a creation, they follow the Title/Agenda.
+        logging.info(f"Constructing requests for {len(slides_to_copy)} slides...")
+        # Slides whose source page could not be read are reported like slides the API rejected.
+        unreadable_slides = []
+        for slide_to_copy in slides_to_copy:
+            # Build the copy requests from the already-fetched source page; no extra API call is needed.
+            source_slide_page = source_pages.get((slide_to_copy['presentation_id'], slide_to_copy['slide_id']))
+            if source_slide_page is None:
+                logging.error(f"Could not copy slide {slide_to_copy['slide_id']}: source presentation {slide_to_copy['presentation_id']} could not be read.")
+                unreadable_slides.append({'slide': slide_to_copy['slide_id'], 'request': None,
+                                          'error': f"Source presentation {slide_to_copy['presentation_id']} could not be read."})
+                continue
+            batch.add(slide_to_copy['slide_id'], _build_copy_requests(slide_to_copy, source_slide_page))
+
+        # Wait for the remaining chunks; slides the API rejected are reported rather than failing the deck.
+        skipped_slides = unreadable_slides + batch.close()
+        logging.info(f"Sent {sum(batch.batch_sizes)} requests in {len(batch.batch_sizes)} batchUpdate calls; {len(skipped_slides)} sub-requests skipped.")
+
+    if slides_to_update_url:
+        # Kept slides stay where they were and copies are appended.
+        deleted = set(plan['delete'])
+        current_slides = [(object_id, None) for object_id in plan['existing_order'] if object_id not in deleted]
+        current_slides += [(object_id, source_id) for object_id, source_id in plan['final'] if source_id is not None]
+        final_slides = plan['final']
+    elif current_slides is not None:
+        # Slides reconstructed from other decks are appended after the kept ones.
+        current_slides += [(f"copied_{s['slide_id']}", s['slide_id']) for s in slides_to_copy]
+
+    # Slides that were never created, by batch group label.
+    missing = {s['slide'] for s in skipped_slides if s['request'] in (None, 'createSlide')}
+    moved = 0
+    if current_slides is not None:
+        # Move the generated slides into the selected order at the end of the deck.
+        with pipeline.stage('reorder_slides'):
+            final_order = [object_id for object_id, label in final_slides if label not in missing]
+            current_order = [object_id for object_id, label in current_slides if label not in missing]
+            move_requests = _reorder_requests(current_order, final_order)
+            if move_requests:
+                reorder = BatchExecutor(slides_service, presentation_id)
+                reorder.add('reorder_slides', move_requests)
+                skipped_slides += reorder.close()
+                moved = len(move_requests)
+
+    report('sharing')
+    with pipeline.stage('share'):
+        if not slides_to_update_url:
+            logging.info("Finished constructing new presentation.")
+            user_email_to_share = deck['user_account']
+            if user_email_to_share:
+                logging.info(f"Sharing presentation with {user_email_to_share}")
+                drive_service.permissions().create(fileId=presentation_id, body={'type': 'user', 'role': 'writer', 'emailAddress': user_email_to_share}, sendNotificationEmail=True).execute()
+            else:
+                logging.warning("No 'user_account' provided in request. Making presentation public (anyone with link).")
+                drive_service.permissions().create(fileId=presentation_id, body={'type': 'anyone', 'role': 'reader'}).execute()
+    
+    final_url = slides_to_update_url or f'https://docs.google.com/presentation/d/{presentation_id}/edit'
+    response_data = {
+        'message': 'Presentation updated successfully' if slides_to_update_url else 'Presentation created successfully',
+        'presentation_id': presentation_id,
+        'presentation_url': final_url,
+        'selected_slides': [slide.reference() for slide in ordered_selected_slides],
+        'library_index': {'hits': library['index_hits'], 'misses': library['index_misses']},
+        'gemini_cache': _gemini_response_cache.stats() if _gemini_response_cache else None,
+        'single_flight': _single_flight_stats(),
+        'rate_limits': rate_limiter.stats(),
+        'skipped_slides': skipped_slides,
+        'unmatched_titles': title_index.unmatched
+    }
+    if plan['base_deck']:
+        response_data['duplicated_from'] = plan['base_deck']
+    if slides_to_update_url:
+        response_data['update_diff'] = {
+            'kept': len(plan['final']) - len(slides_to_copy),
+            'copied': sum(1 for s in slides_to_copy if s['slide_id'] not in missing),
+            'deleted': len(plan['delete']),
+            'moved': moved
+        }
+    logging.info(f"Successfully processed presentation: {final_url}")
+    return response_data, 200
+
+
+def _generate_presentation(request_json, identity, credentials, project_id, region, pipeline, report_progress=None):
+    """Creates or updates a presentation from the slides Gemini selects for the request.
+
+    Stages are timed on pipeline, which the caller should have active. Returns
+    (response_data, 200) on success or (error_message, status) for request errors;
+    Google API errors are raised to the caller. report_progress, if given, is
+    called with the current stage name and keyword progress fields.
+    """
+    report = report_progress or _ignore_progress
+    source_folder_url = request_json.get('source_folder_url') # BACK TO FOLDER URL
+    if not all([request_json.get('customer_request'), request_json.get('duration'), source_folder_url]):
+        return ("Error: Missing 'customer_request', 'duration', or 'source_folder_url' in JSON payload.", 400)
+    
+    # Reuse the pooled API clients for the credentials established earlier.
+    slides_service = clients.get_service(identity, credentials, 'slides', 'v1')
+    drive_service = clients.get_service(identity, credentials, 'drive', 'v3')
+    
+    # 2. Fetch and parse ALL presentations from the Google Drive folder
+    folder_id_match = re.search(r'/folders/([a-zA-Z0-9-_]+)', source_folder_url)
+    if not folder_id_match:
+        return ("Error: Invalid Google Drive Folder URL format.", 400)
+    folder_id = folder_id_match.group(1)
+
+    deck, error = _deck_spec(request_json)
+    if error:
+        return error
+
+    # Stages that do not depend on each other run concurrently.
+    gemini_model = clients.get_generative_model(identity, credentials, os.environ.get('GEMINI_MODEL_NAME', 'gemini-2.5-pro'), project_id, region)
+    _start_deck_stages(pipeline, slides_service, gemini_model, deck)
+
+    report('listing_folder')
+    library, error = _load_shared_library(identity, slides_service, drive_service, folder_id, pipeline, report)
+    if error:
+        return error
+
+    report('selecting_slides')
+    embedder = _get_embedder(identity, credentials, project_id, region)
+    ordered_selected_slides, title_index, error = _select_deck_slides(gemini_model, library, deck, embedder, pipeline)
+    if error:
+        return error
+
+    plan, error = _plan_deck(pipeline, deck, ordered_selected_slides)
+    if error:
+        return error
+    _start_create_presentation(pipeline, slides_service, drive_service, deck, plan)
+
+    report('fetching_pages')
+    with pipeline.stage('fetch_selected_pages'):
+        _fetch_selected_pages(slides_service, library, plan['copy'])
+
+    return _build_deck(slides_service, drive_service, pipeline, deck, library, plan, ordered_selected_slides, title_index, report)
+
+
+def _generate_presentation_once(request_json, identity, credentials, project_id, region, pipeline, report_progress=None):
+    """Runs _generate_presentation(), or joins an identical request from the same identity already in flight.
+
+    Results are copies marked with whether they were 'coalesced', so a
+    double-submitted request builds one deck. Stages and progress are only
+    recorded by the request that did the work.
+    """
+    key = content_key(identity, {k: v for k, v in request_json.items() if k != 'include_timings'})
+    (result, status), shared = _request_flights.do(
+        key, lambda: _generate_presentation(request_json, identity, credentials, project_id, region, pipeline, report_progress))
+    record_cache_lookup('coalesced_request', shared)
+    if isinstance(result, dict):
+        # Callers add their own fields, such as 'timings', so none of them gets the shared dict.
+        result = {**result, 'coalesced': shared}
+    return result, status
+
+
+def _generate_presentations_batch(request_json, identity, credentials, project_id, region, library_pipeline):
+    """Builds several presentations from one source folder, listing and extracting the library once.
+
+    Each entry of 'presentations' takes the same fields as a single request and inherits
+    any it omits (such as user_account or meeting_date) from the top level. Selections run
+    concurrently, then decks are built on a shared pool of BATCH_CONCURRENCY workers.
+    The shared library work is timed on library_pipeline and each deck gets its own.
+    Returns (response_data, 200) with a result or error per deck, or (error_message, status).
+    """
+    entries = request_json.get('presentations')
+    source_folder_url = request_json.get('source_folder_url')
+    if not entries or not isinstance(entries, list) or not source_folder_url:
+        return ("Error: 'presentations' (a non-empty list) and 'source_folder_url' are required for batch generation.", 400)
+
+    shared_fields = {k: v for k, v in request_json.items() if k not in ('action', 'presentations')}
+    decks = []
+    for i, entry in enumerate(entries):
+        entry = {**shared_fields, **entry}
+        if not all([entry.get('customer_request'), entry.get('duration')]):
+            return (f"Error: Missing 'customer_request' or 'duration' in presentations[{i}].", 400)
+        deck, error = _deck_spec(entry)
+        if error:
+            return (f"{error[0]} (presentations[{i}])", error[1])
+        decks.append(deck)
+
+    folder_id_match = re.search(r'/folders/([a-zA-Z0-9-_]+)', source_folder_url)
+    if not folder_id_match:
+        return ("Error: Invalid Google Drive Folder URL format.", 400)
+    folder_id = folder_id_match.group(1)
+
+    slides_service = clients.get_service(identity, credentials, 'slides', 'v1')
+    drive_service = clients.get_service(identity, credentials, 'drive', 'v3')
+    gemini_model = clients.get_generative_model(identity, credentials, os.environ.get('GEMINI_MODEL_NAME', 'gemini-2.5-pro'), project_id, region)
+    concurrency = int(os.environ.get('BATCH_CONCURRENCY', DEFAULT_BATCH_CONCURRENCY))
+
+    # One pipeline per deck, so each deck reports its own timings and API usage.
+    pipelines = [Pipeline() for _ in decks]
+    for pipeline, deck in zip(pipelines, decks):
+        _start_deck_stages(pipeline, slides_service, gemini_model, deck)
+
+    library, error = _load_shared_library(identity, slides_service, drive_service, folder_id, library_pipeline)
+    if error:
+        return error
+    embedder = _get_embedder(identity, credentials, project_id, region)
+
+    # A deck that fails is reported in its own result instead of failing the whole batch.
+    results = [None] * len(decks)
+
+    def deck_error(i, message):
+        results[i] = {'customer_request': decks[i]['customer_request'], 'status': 'failed', 'error': message, 'timings': pipelines[i].summary()}
+
+    def select(i):
+        try:
+            with pipelines[i].activate():
+                return _select_deck_slides(gemini_model, library, decks[i], embedder, pipelines[i])
+        except Exception as e:
+            logging.error(f"Slide selection failed for presentations[{i}]: {e}", exc_info=True)
+            return None, None, (f"An unexpected error occurred: {e}", 500)
+
+    with library_pipeline.stage('select_slides'):
+        selections = _run_concurrently(select, range(len(decks)), max_workers=concurrency)
+    selected = []
+    plans = {}
+    for i, (slides, title_index, error) in enumerate(selections):
+        if error:
+            deck_error(i, error[0])
+            continue
+        try:
+            plans[i], error = _plan_deck(pipelines[i], decks[i], slides)
+        except Exception as e:
+            # The deck being updated is read in the background; any error it raised surfaces here.
+            logging.error(f"Planning presentations[{i}] failed: {e}", exc_info=True)
+            error = (f"An unexpected error occurred: {e}", 500)
+        if error:
+            deck_error(i, error[0])
+            continue
+        _start_create_presentation(pipelines[i], slides_service, drive_service, decks[i], plans[i])
+        selected.append(i)
+
+    # Pages are fetched once for the union of the slides every deck copies.
+    with library_pipeline.stage('fetch_selected_pages'):
+        _fetch_selected_pages(slides_service, library, [slide for i in selected for slide in plans[i]['copy']])
+
+    def build(i):
+        slides, title_index, _ = selections[i]
+        try:
+            with pipelines[i].activate():
+                result, status = _build_deck(slides_service, drive_service, pipelines[i], decks[i], library, plans[i], slides, title_index, _ignore_progress)
+        except HttpError as err:
+            logging.error(f"Building presentations[{i}] failed: {err}", exc_info=True)
+            deck_error(i, f"An API error occurred: {err.content.decode('utf-8')}")
+            return
+        except Exception as e:
+            logging.error(f"Building presentations[{i}] failed: {e}", exc_info=True)
+            deck_error(i, f"An unexpected error occurred: {e}")
+            return
+        if status != 200:
+            deck_error(i, result)
+            return
+        results[i] = {'customer_request': decks[i]['customer_request'], 'status': 'succeeded', **result, 'timings': pipelines[i].summary()}
+
+    with library_pipeline.stage('build_decks'):
+        _run_concurrently(build, selected, max_workers=concurrency)
+
+    succeeded = sum(1 for result in results if result['status'] == 'succeeded')
+    logging.info(f"Batch generation: {succeeded} of {len(decks)} presentations succeeded.")
+    return {
+        'message': f"Generated {succeeded} of {len(decks)} presentations",
+        'library': {
+            'presentations': len(library['decks']),
+            'slides': library['slide_count'],
+            'index': {'hits': library['index_hits'], 'misses': library['index_misses']},
+            'timings': library_pipeline.summary()
+        },
+        'gemini_cache': _gemini_response_cache.stats() if _gemini_response_cache else None,
+        'single_flight': _single_flight_stats(),
+        'rate_limits': rate_limiter.stats(),
+        'presentations': results
+    }, 200
+
+
+def _run_job(job_id, request_json, identity, credentials, project_id, region):
+    """Builds a presentation on a background worker, recording its progress in the job store."""
+    job_store = JobStore()
+    job_store.update(job_id, status='running', stage='starting')
+
+    def report_progress(stage, **progress):
+        job_store.update(job_id, stage=stage, **progress)
+
+    try:
+        pipeline = Pipeline()
+        with pipeline.trace('submit_job'):
+            result, status = _generate_presentation_once(request_json, identity, credentials, project_id, region, pipeline, report_progress)
+        if status == 200:
+            if request_json.get('include_timings'):
+                result['timings'] = pipeline.summary()
+            job_store.update(job_id, status='succeeded', stage='done', result=result)
+        else:
+            job_store.update(job_id, status='failed', error=result)
+    except HttpError as err:
+        error_content = err.content.decode('utf-8')
+        logging.error(f"Job {job_id} failed with an HttpError: {error_content}", exc_info=True)
+        job_store.update(job_id, status='failed', error=f"An API error occurred: {error_content}")
+    except Exception as e:
+        logging.error(f"Job {job_id} failed: {e}", exc_info=True)
+        job_store.update(job_id, status='failed', error=f"An unexpected error occurred: {e}")
+
+
+def _job_status(job):
+    result = job['result'] or {}
+    return {
+        'job_id': job['id'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'progress': {'copied': job['copied'] or 0, 'total': job['total'] or 0},
+        'presentation_url': result.get('presentation_url'),
+        'result': job['result'],
+        'error': job['error']
+    }
+
+
 @functions_framework.http
 def generate_presentation(request):
     """HTTP Cloud Function that generates a Google Slides presentation OR speaker notes."""
@@ -80,28 +1424,19 @@ def generate_presentation(request):
         # Prioritize user-delegated credentials passed via Authorization header.
         # This is used by the delegated_test_client.py script.
         # Fall back to the function's service account credentials if no header is present.
+        # Clients and models are pooled per credential identity, so warm instances reuse them.
         auth_header = request.headers.get('Authorization')
-        if auth_header and auth_header.startswith('Bearer '):
-            token = auth_header.split(' ')[1]
-            # When using a bearer token, we create credentials directly from it.
-            # The scopes here are for validation and should align with what the client requested.
-            scopes = ['https://www.googleapis.com/auth/presentations', 'https://www.googleapis.com/auth/drive', 'https://www.googleapis.com/auth/cloud-platform']
-            credentials = oauth2_credentials.Credentials(token, scopes=scopes)
-            logging.info("Using user-delegated credentials from Authorization header.")
-        else:
-            # Use google.auth.default() for service account credentials.
-            # This works for local testing (with GOOGLE_APPLICATION_CREDENTIALS from configure.sh)
-            # and when deployed (using the runtime service account).
-            scopes = ['https://www.googleapis.com/auth/presentations', 'https://www.googleapis.com/auth/drive', 'https://www.googleapis.com/auth/cloud-platform']
-            credentials, _ = google.auth.default(scopes=scopes)
+        identity, credentials = clients.get_credentials(auth_header)
+        if identity == clients.DEFAULT_IDENTITY:
             logging.info("Using default service account credentials.")
+        else:
+            logging.info("Using user-delegated credentials from Authorization header.")
 
-        # Initialize Vertex AI SDK for the project and location.
+        # Vertex AI is initialized for the project and location when a model is first pooled.
         # This ensures the function uses the correct enterprise endpoint (aiplatform.googleapis.com).
         try:
             project_id = os.environ['PROJECT_ID']
             region = os.environ['REGION']
-            vertexai.init(project=project_id, location=region, credentials=credentials)
         except KeyError as e:
             logging.error(f"Missing environment variable: {e}. Please set PROJECT_ID and REGION during deployment.")
             return (f"Server configuration error: Missing environment variable {e}", 500, headers)
@@ -126,363 +1461,86 @@ def generate_presentation(request):
             slides_data = request_json.get('slides_data')
             if not slides_data:
                 return ("Error: 'slides_data' is required for generating speaker notes.", 400, headers)
+            slides_data, error = _resolve_slide_contents(slides_data, identity, credentials)
+            if error:
+                return (error[0], error[1], headers)
 
-            gemini_model = GenerativeModel(os.environ.get('GEMINI_MODEL_NAME', 'gemini-2.5-pro'))
-            
-            slides_text = '\n\n'.join([f"Slide Title: {slide.get('title', '')}\nSlide Content: {slide.get('content', '')}" for slide in slides_data])
-            
-            prompt = f"""You are a public speaking coach. A user has a presentation with the following slides. Your task is to generate concise and conversational speaker notes for each slide. Focus on the key takeaways and provide guidance on how to present the information effectively. Use a friendly and encouraging tone.
+            model_name = os.environ.get('GEMINI_MODEL_NAME', 'gemini-2.5-pro')
+            gemini_model = clients.get_generative_model(identity, credentials, model_name, project_id, region)
 
-                        Slides:
-                        {slides_text}
-                        
-                        Please format your response as a Markdown document with a top-level heading for each slide, followed by bullet points for the notes."""
+            shard_size = int(request_json.get('shard_size') or os.environ.get('NOTES_SHARD_SIZE', DEFAULT_NOTES_SHARD_SIZE))
+            concurrency = int(os.environ.get('NOTES_CONCURRENCY', DEFAULT_NOTES_CONCURRENCY))
+
+            # Traces the request's Gemini calls; 'include_timings' also returns the trace.
+            pipeline = Pipeline()
+            if request_json.get('stream'):
+                # Server-sent events, flushed slide by slide as Gemini streams its answer.
+                # Clients that do not send 'stream' keep getting the single JSON response below.
+                response_headers = headers.copy()
+                response_headers['Cache-Control'] = 'no-cache'
+                response_headers['X-Accel-Buffering'] = 'no'
+                events = pipeline.iterate(_stream_speaker_notes(gemini_model, model_name, slides_data, shard_size, concurrency), 'generate_speaker_notes')
+                return Response(events, status=200, headers=response_headers, mimetype='text/event-stream')
 
-            gemini_response = gemini_model.generate_content(prompt)
+            # Only slides whose title or content changed since their notes were cached go to Gemini.
+            with pipeline.trace('generate_speaker_notes'), pipeline.stage('generate_notes'):
+                notes, cached_count = _generate_speaker_notes(gemini_model, model_name, slides_data, shard_size, concurrency)
+            logging.info(f"Speaker notes: {cached_count} of {len(slides_data)} slides served from cache.")
             
+            response_data = {'notes': notes, 'cached_slides': cached_count}
+            if request_json.get('include_timings'):
+                response_data['timings'] = pipeline.summary()
             response_headers = headers.copy()
             response_headers['Content-Type'] = 'application/json'
-            return (json.dumps({'notes': gemini_response.text}), 200, response_headers)
+            return (json.dumps(response_data), 200, response_headers)
 
         elif action == 'generate_presentation':
-            customer_request = request_json.get('customer_request')
-            duration = request_json.get('duration')
-            source_folder_url = request_json.get('source_folder_url') # BACK TO FOLDER URL
-            slides_to_update_url = request_json.get('slides_to_update')
-            
-            # Construct the presentation title by combining slide_title and meeting_date
-            slide_title = request_json.get('slide_title')
-            meeting_date = request_json.get('meeting_date')
-            title_base = slide_title or customer_request
-            if meeting_date:
-                presentation_title = f"{title_base} ({meeting_date})"
-            else:
-                presentation_title = title_base
-            
-            if not all([customer_request, duration, source_folder_url]):
-                return ("Error: Missing 'customer_request', 'duration', or 'source_folder_url' in JSON payload.", 400, headers)
-            
-            # Build API clients using the credentials established earlier.
-            slides_service = build('slides', 'v1', credentials=credentials)
-            drive_service = build('drive', 'v3', credentials=credentials)
-            
-            # 2. Fetch and parse ALL presentations from the Google Drive folder
-            folder_id_match = re.search(r'/folders/([a-zA-Z0-9-_]+)', source_folder_url)
-            if not folder_id_match:
-                return ("Error: Invalid Google Drive Folder URL format.", 400, headers)
-            folder_id = folder_id_match.group(1)
-            
-            # Query for both actual presentations and shortcuts to presentations.
-            query = f"'{folder_id}' in parents and (mimeType='application/vnd.google-apps.presentation' or mimeType='application/vnd.google-apps.shortcut') and trashed=false"
-            response = drive_service.files().list(q=query, fields='files(id, name, mimeType, shortcutDetails)').execute()
-            files_in_folder = response.get('files', [])
-
-            presentations_to_process = []
-            for f in files_in_folder:
-                if f.get('mimeType') == 'application/vnd.google-apps.presentation':
-                    presentations_to_process.append({'id': f.get('id'), 'name': f.get('name')})
-                elif f.get('mimeType') == 'application/vnd.google-apps.shortcut':
-                    target_id = f.get('shortcutDetails', {}).get('targetId')
-                    if target_id:
-                        try:
-                            # For shortcuts, get the target file's metadata to ensure it's a presentation.
-                            target_file = drive_service.files().get(fileId=target_id, fields='id, name, mimeType').execute()
-                            if target_file.get('mimeType') == 'application/vnd.google-apps.presentation':
-                                presentations_to_process.append({'id': target_file.get('id'), 'name': target_file.get('name')})
-                        except HttpError as err:
-                            if err.resp.status == 404:
-                                logging.warning(
-                                    f"Could not resolve shortcut '{f.get('name')}' because the target file (ID: {target_id}) was not found. "
-                                    f"This usually means the service account does not have permission to view the original file. "
-                                    f"Please share the original presentation with this function's service account email."
-                                )
-                            else:
-                                logging.warning(f"An unexpected API error occurred while resolving shortcut '{f.get('name')}': {err}")
-            
-            if not presentations_to_process:
-                return (f"Error: No presentations or valid shortcuts to presentations found in folder '{folder_id}'.", 400, headers)
-
-            source_slides = []
-            for pres in presentations_to_process:
-                presentation_obj = slides_service.presentations().get(presentationId=pres.get('id')).execute()
-                slides = extract_slides_from_presentation(presentation_obj, pres.get('name'))
-                source_slides.extend(slides)
-            
-            if not source_slides:
-                return ("Error: Could not find any slides with titles in the provided presentations.", 400, headers)
-
-            # 3. Use Gemini to select relevant slides
-            gemini_model = GenerativeModel(os.environ.get('GEMINI_MODEL_NAME', 'gemini-2.5-pro'))
-            prompt = f"""You are a presentation strategist. A user wants to create a presentation deck. Their request is: "{customer_request}".
-                         You have a library of all available slide titles. Select the most relevant titles to create a coherent presentation for a {duration} presentation. 
-                         The user has provided an agenda for the new slide deck in their request. Think carefully about your selected slides to ensure they match the agenda provided by the user in their request.
-                         Available Slides: {json.dumps([s['title'] for s in source_slides])}
-                         Return a JSON object with a single key "selected_slides" which is an array of the selected slide titles in the optimal order."""
-            gemini_response = gemini_model.generate_content(prompt)
-            
-            try:
-                json_match = re.search(r'```json\s*({[\s\S]*?})\s*```', gemini_response.text)
-                json_str = json_match.group(1) if json_match else gemini_response.text.strip()
-                selected_titles = json.loads(json_str).get('selected_slides', [])
-            except (json.JSONDecodeError, AttributeError):
-                return (f"Error: Gemini API returned a non-JSON response: '{gemini_response.text}'.", 500, headers)
-
-            ordered_selected_slides = []
-            temp_source_slides = list(source_slides)
-            for title in selected_titles:
-                for i, slide in enumerate(temp_source_slides):
-                    if slide['title'] == title:
-                        ordered_selected_slides.append(slide)
-                        temp_source_slides.pop(i)
-                        break
-
-            requests = []
-            presentation_id = None
-
-            if slides_to_update_url:
-                # --- UPDATE EXISTING PRESENTATION FLOW ---
-                presentation_id_match = re.search(r'/d/([a-zA-Z0-9-_]+)', slides_to_update_url)
-                if not presentation_id_match:
-                    return ("Error: Invalid 'slides_to_update' URL format.", 400, headers)
-                presentation_id = presentation_id_match.group(1)
-                
-                try:
-                    existing_presentation = slides_service.presentations().get(presentationId=presentation_id).execute()
-                except HttpError as err:
-                    return (f"Error: Could not access presentation to update. {err}", 403, headers)
-
-                # Identify unmodified, script-generated slides to delete
-                # We skip the first two slides (Title and Agenda) to preserve them.
-                slides_to_delete = []
-                for i, slide in enumerate(existing_presentation.get('slides', [])):
-                    if i < 2:  # Skip the first two slides (Title and Agenda)
-                        continue
-
-                    # Find any text box that looks like our generated source link.
-                    # This is more robust than assuming it's always in a 'TITLE' placeholder.
-                    is_generated_slide = False
-                    for element in slide.get('pageElements', []):
-                        if 'shape' in element and 'text' in element['shape']:
-                            element_text = _get_text_from_element(element)
-                            if element_text.startswith("Source: "):
-                                # Check if any part of the text has a link.
-                                has_link = any(
-                                    text_run.get('textRun', {}).get('style', {}).get('link')
-                                    for text_run in element['shape']['text'].get('textElements', [])
-                                )
-                                if has_link:
-                                    is_generated_slide = True
-                                    break  # Found the source text box, no need to check other elements
-                    if is_generated_slide:
-                        slides_to_delete.append(slide['objectId'])
-
-                for slide_id in slides_to_delete:
-                    requests.append({'deleteObject': {'objectId': slide_id}})
-                logging.info(f"Identified {len(slides_to_delete)} script-generated slides to remove and update.")
+            # Stage spans, Google API usage and Gemini tokens are logged as one JSON
+            # record per request; 'include_timings' also returns them in the response.
+            pipeline = Pipeline()
+            with pipeline.trace('generate_presentation'):
+                result, status = _generate_presentation_once(request_json, identity, credentials, project_id, region, pipeline)
+            if status != 200:
+                return (result, status, headers)
+            if request_json.get('include_timings'):
+                result['timings'] = pipeline.summary()
+            response_headers = headers.copy()
+            response_headers['Content-Type'] = 'application/json'
+            return (json.dumps(result), 200, response_headers)
 
-            else:
-                # --- CREATE NEW PRESENTATION FLOW ---
-                new_presentation = slides_service.presentations().create(body={'title': presentation_title}).execute()
-                presentation_id = new_presentation.get('presentationId')
-                
-                # Delete the default slide that comes with a new presentation.
-                requests.append({'deleteObject': {'objectId': new_presentation.get('slides')[0]['objectId']}})
-
-                # Create a new, clean title slide from a predefined layout.
-                title_slide_id = 'title_slide_01'
-                title_shape_id = 'title_shape_01'
-                subtitle_shape_id = 'subtitle_shape_01'
-                requests.extend([
-                    {'createSlide': {
-                        'objectId': title_slide_id,
-                        'insertionIndex': 0,
-                        'slideLayoutReference': {'predefinedLayout': 'TITLE'},
-                        'placeholderIdMappings': [
-                            {'layoutPlaceholder': {'type': 'CENTERED_TITLE'}, 'objectId': title_shape_id},
-                            {'layoutPlaceholder': {'type': 'SUBTITLE'}, 'objectId': subtitle_shape_id}
-                        ]
-                    }},
-                    {'insertText': {'objectId': title_shape_id, 'text': presentation_title}},
-                    {'insertText': {'objectId': subtitle_shape_id, 'text': 'Generated by Gemini Code Assist'}}
-                ])
-                
-                # Generate and create the Agenda slide, including its content, in one step.
-                agenda_prompt = f"Generate a concise, bulleted list for an agenda for a presentation about the following topic: '{customer_request}'. Do not add any introductory text, just the bullet points."
-                agenda_content = gemini_model.generate_content(agenda_prompt).text
-                agenda_slide_id = 'agenda_slide_01'
-                title_shape_id = 'agenda_title_shape_01'
-                body_shape_id = 'agenda_body_shape_01'
-                requests.extend([
-                    {'createSlide': {
-                        'objectId': agenda_slide_id,
-                        'insertionIndex': 1, # Insert after the title slide
-                        'slideLayoutReference': {'predefinedLayout': 'TITLE_AND_BODY'},
-                        'placeholderIdMappings': [
-                            {'layoutPlaceholder': {'type': 'TITLE'}, 'objectId': title_shape_id},
-                            {'layoutPlaceholder': {'type': 'BODY'}, 'objectId': body_shape_id}
-                        ]
-                    }},
-                    {'insertText': {'objectId': title_shape_id, 'text': 'Agenda'}},
-                    {'insertText': {'objectId': body_shape_id, 'text': agenda_content}}
-                ])
-
-            # This logic is now common to both create and update flows.
-            # It constructs requests to add the newly selected slides.
-            # In an update, they will be appended. In a creation, they follow the Title/Agenda.
-            logging.info(f"Constructing requests for {len(ordered_selected_slides)} slides...")
-            for slide_to_copy in ordered_selected_slides:
-                try:
-                    # Get the full details of the source slide.
-                    source_slide_page = slides_service.presentations().pages().get(
-                        presentationId=slide_to_copy['presentation_id'],
-                        pageObjectId=slide_to_copy['slide_id']
-                    ).execute()
-
-                    new_slide_id = f"copied_{slide_to_copy['slide_id']}"
-
-                    # Request to create a new slide with a title placeholder.
-                    new_title_shape_id = f"title_for_{new_slide_id}"
-                    # By omitting slideLayoutReference, we let the Slides API choose a default layout from the master.
-                    # This is robust against custom themes that may not have a 'BLANK' layout.
-                    requests.append({'createSlide': {'objectId': new_slide_id}})
-
-                    # Manually create a text box to act as the title for the source link.
-                    requests.append({
-                        'createShape': {
-                            'objectId': new_title_shape_id,
-                            'shapeType': 'TEXT_BOX',
-                            'elementProperties': {
-                                'pageObjectId': new_slide_id,
-                                'size': {'height': {'magnitude': 500000, 'unit': 'EMU'}, 'width': {'magnitude': 8500000, 'unit': 'EMU'}},
-                                'transform': {'scaleX': 1, 'scaleY': 1, 'translateX': 300000, 'translateY': 200000, 'unit': 'EMU'}
-                            }
-                        }
-                    })
+        elif action == 'generate_presentations_batch':
+            pipeline = Pipeline()
+            with pipeline.trace('generate_presentations_batch'):
+                result, status = _generate_presentations_batch(request_json, identity, credentials, project_id, region, pipeline)
+            if status != 200:
+                return (result, status, headers)
+            response_headers = headers.copy()
+            response_headers['Content-Type'] = 'application/json'
+            return (json.dumps(result), 200, response_headers)
 
-                    # Add request to set the new title with source information.
-                    new_title_text = f"Source: {slide_to_copy['presentation_name']} (Slide {slide_to_copy['slide_number']})"
-                    requests.append({
-                        'insertText': {'objectId': new_title_shape_id, 'text': new_title_text}
-                    })
+        elif action == 'submit_job':
+            # Long deck builds run in the background; poll 'job_status' with the returned job_id.
+            if not all([request_json.get('customer_request'), request_json.get('duration'), request_json.get('source_folder_url')]):
+                return ("Error: Missing 'customer_request', 'duration', or 'source_folder_url' in JSON payload.", 400, headers)
+            job_id = JobStore().create()
+            _job_executor.submit(_run_job, job_id, request_json, identity, credentials, project_id, region)
+            logging.info(f"Queued presentation job {job_id}.")
 
-                    # Add a request to make the source text a hyperlink to the original slide.
-                    source_slide_url = f"https://docs.google.com/presentation/d/{slide_to_copy['presentation_id']}/edit#slide=id.{slide_to_copy['slide_id']}"
-                    requests.append({
-                        'updateTextStyle': {
-                            'objectId': new_title_shape_id,
-                            'style': {
-                                'link': {'url': source_slide_url}
-                            },
-                            'textRange': {'type': 'ALL'},
-                            'fields': 'link'
-                        }
-                    })
+            response_headers = headers.copy()
+            response_headers['Content-Type'] = 'application/json'
+            return (json.dumps({'job_id': job_id, 'status': 'queued'}), 202, response_headers)
+
+        elif action == 'job_status':
+            job_id = request_json.get('job_id')
+            if not job_id:
+                return ("Error: 'job_id' is required for checking job status.", 400, headers)
+            job = JobStore().get(job_id)
+            if job is None:
+                return (f"Error: Unknown job '{job_id}'.", 404, headers)
 
-                    # Request to copy the background from the source slide.
-                    source_properties = source_slide_page.get('slideProperties', {})
-                    if source_properties.get('slideBackgroundFill'):
-                        requests.append({
-                            'updatePageProperties': {
-                                'objectId': new_slide_id,
-                                'pageProperties': {'pageBackgroundFill': source_properties['slideBackgroundFill']},
-                                'fields': 'pageBackgroundFill'
-                            }
-                        })
-
-                    # Create requests to copy each element (shapes, text, images).
-                    if source_slide_page.get('pageElements'):
-                        for element in source_slide_page['pageElements']:
-                            if 'placeholder' in element.get('shape', {}):
-                                continue # Skip placeholders as they are part of the layout.
-
-                            new_element = copy.deepcopy(element)
-                            new_element['objectId'] = f"copied_{element['objectId']}"
-                            
-                            if 'shape' in new_element:
-                                # Use .get() to safely access 'shapeType' and provide a default
-                                # value if it's missing, preventing a KeyError.
-                                shape_type = new_element['shape'].get('shapeType', 'RECTANGLE')
-                                requests.append({
-                                    'createShape': {
-                                        'objectId': new_element['objectId'], 
-                                        'elementProperties': {'pageObjectId': new_slide_id, 'size': new_element.get('size'), 'transform': new_element.get('transform')}, 
-                                        'shapeType': shape_type
-                                    }
-                                })
-
-                                # NEW: Add a request to update the shape's properties (fill, outline, etc.) to fix formatting.
-                                if 'shapeProperties' in new_element['shape']:
-                                    requests.append({
-                                        'updateShapeProperties': {
-                                            'objectId': new_element['objectId'],
-                                            'shapeProperties': new_element['shape']['shapeProperties'],
-                                            'fields': 'shapeBackgroundFill,outline,shadow'  # Use a specific field mask to avoid read-only fields.
-                                        }
-                                    })
-
-                                if 'text' in new_element['shape']:
-                                    full_text = _get_text_from_element(new_element)
-                                    if full_text:
-                                        requests.append({'insertText': {'objectId': new_element['objectId'], 'text': full_text, 'insertionIndex': 0}})
-                                        # NEW: Apply the style from the first text run to the entire shape to improve text formatting.
-                                        first_style = next((te['textRun']['style'] for te in new_element['shape']['text'].get('textElements', []) if te.get('textRun') and te['textRun'].get('style')), None)
-                                        if first_style:
-                                            requests.append({'updateTextStyle': {
-                                                'objectId': new_element['objectId'],
-                                                'style': first_style,
-                                                'textRange': {'type': 'ALL'},
-                                                'fields': 'bold,italic,underline,strikethrough,fontFamily,fontSize,foregroundColor,backgroundColor' # Use a specific field mask.
-                                            }})
-                            elif 'image' in new_element:
-                                # The 'contentUrl' for an image is temporary and not publicly accessible,
-                                # which causes the 'createImage' request to fail with a 400 error.
-                                # The 'sourceUrl' field, if present, often points to the original,
-                                # publicly accessible URL and is more reliable for copying.
-                                image_url = new_element['image'].get('sourceUrl')
-
-                                if image_url:
-                                    requests.append({'createImage': {
-                                        'objectId': new_element['objectId'],
-                                        'url': image_url,
-                                        'elementProperties': {
-                                            'pageObjectId': new_slide_id,
-                                            'size': new_element.get('size'),
-                                            'transform': new_element.get('transform')
-                                        }
-                                    }})
-                                else:
-                                    # If no public sourceUrl is available (e.g., for copy-pasted images),
-                                    # log a warning and skip this element to prevent the function from crashing.
-                                    logging.warning(f"Skipping image element '{new_element['objectId']}' from source slide '{slide_to_copy['slide_id']}' because it does not have a public 'sourceUrl'. This is a known limitation when copying pasted images via the Slides API.")
-                except HttpError as err:
-                    logging.error(f"Could not copy slide {slide_to_copy['slide_id']}: {err}")
-
-            # Execute all requests in a single batch update.
-            if requests:
-                slides_service.presentations().batchUpdate(presentationId=presentation_id, body={'requests': requests}).execute()
-
-            # Share presentation (only for new presentations) and prepare response
-            if not slides_to_update_url:
-                logging.info("Finished constructing new presentation.")
-                user_email_to_share = request_json.get('user_account')
-                if user_email_to_share:
-                    logging.info(f"Sharing presentation with {user_email_to_share}")
-                    drive_service.permissions().create(fileId=presentation_id, body={'type': 'user', 'role': 'writer', 'emailAddress': user_email_to_share}, sendNotificationEmail=True).execute()
-                else:
-                    logging.warning("No 'user_account' provided in request. Making presentation public (anyone with link).")
-                    drive_service.permissions().create(fileId=presentation_id, body={'type': 'anyone', 'role': 'reader'}).execute()
-            
-            final_url = slides_to_update_url or f'https://docs.google.com/presentation/d/{presentation_id}/edit'
-            response_data = {
-                'message': 'Presentation updated successfully' if slides_to_update_url else 'Presentation created successfully',
-                'presentation_id': presentation_id,
-                'presentation_url': final_url,
-                'selected_slides': ordered_selected_slides
-            }
-            logging.info(f"Successfully processed presentation: {final_url}")
             response_headers = headers.copy()
             response_headers['Content-Type'] = 'application/json'
-            return (json.dumps(response_data), 200, response_headers)
+            return (json.dumps(_job_status(job)), 200, response_headers)
         
         else:
             return (f"Error: Unknown action '{action}'.", 400, headers)
@@ -0,0 +1,209 @@
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Shared by all requests on an instance. Stages that are abandoned by an early
+# error return simply finish in the background without blocking anyone.
+_stage_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='stage')
+
+# The pipeline that Google API calls and Gemini calls made in this context are recorded on.
+_current_pipeline = contextvars.ContextVar('pipeline', default=None)
+
+# Traces are written as single-line JSON to stdout, which Cloud Logging parses into
+# jsonPayload (with 'severity' and 'message' mapped to the entry's own fields).
+# Set TRACE_LOGS=0 to turn them off.
+_trace_logger = logging.getLogger('slide_generator.trace')
+_trace_logger.propagate = False
+_trace_logger.setLevel(logging.INFO)
+if not _trace_logger.handlers:
+    _trace_handler = logging.StreamHandler(sys.stdout)
+    _trace_handler.setFormatter(logging.Formatter('%(message)s'))
+    _trace_logger.addHandler(_trace_handler)
+
+
+def current():
+    """Returns the pipeline active in this context, or None."""
+    return _current_pipeline.get()
+
+
+def propagate(func):
+    """Wraps func to run in a copy of the caller's context, so work handed to another thread reports to the same pipeline."""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # Each call gets its own copy: one Context cannot be entered by two threads at once.
+        return context.copy().run(func, *args, **kwargs)
+    return run
+
+
+def record_api_call(service, request_bytes, response_bytes, seconds, error=False):
+    """Adds a Google API call to the current pipeline, if there is one."""
+    pipeline = current()
+    if pipeline is not None:
+        pipeline._record_api_call(service, request_bytes, response_bytes, seconds, error)
+
+
+def record_gemini_call(usage_metadata, seconds, error=False):
+    """Adds a Gemini call and its token usage (a response's usage_metadata, if any) to the current pipeline."""
+    pipeline = current()
+    if pipeline is not None:
+        pipeline._record_gemini_call(usage_metadata, seconds, error)
+
+
+def record_cache_lookup(name, hit):
+    """Adds a hit or miss on the cache called name to the current pipeline."""
+    pipeline = current()
+    if pipeline is not None:
+        pipeline._record_cache_lookup(name, hit)
+
+
+def record_throttle(quota, seconds, retries):
+    """Adds a call's time queued for or backing off from a rate-limited quota to the current pipeline."""
+    pipeline = current()
+    if pipeline is not None:
+        pipeline._record_throttle(quota, seconds, retries)
+
+
+class Pipeline:
+    """Runs the independent stages of one request concurrently and records when each ran.
+
+    Background stages are started with start() and joined with result(); inline
+    stages are timed with the stage() context manager. While a pipeline is active
+    (see trace() and activate()) it also counts the Google API calls, payload bytes
+    Gemini tokens, rate-limit waits and response-cache lookups of its request. summary() returns all of it, and log_trace()
+    writes it as one JSON record, which shows the critical path.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.timings = {}
+        self.api_calls = {}
+        self.gemini = {'calls': 0, 'errors': 0, 'seconds': 0.0, 'prompt_tokens': 0, 'output_tokens': 0}
+        self.cache = {}
+        self.throttle = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def _record(self, name, start, end):
+        with self._lock:
+            self.timings[name] = {'start': round(start - self.started_at, 3), 'end': round(end - self.started_at, 3)}
+
+    def _record_api_call(self, service, request_bytes, response_bytes, seconds, error):
+        with self._lock:
+            stats = self.api_calls.setdefault(service, {'calls': 0, 'errors': 0, 'request_bytes': 0, 'response_bytes': 0, 'seconds': 0.0})
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            stats['request_bytes'] += request_bytes
+            stats['response_bytes'] += response_bytes
+            stats['seconds'] += seconds
+
+    def _record_gemini_call(self, usage_metadata, seconds, error):
+        with self._lock:
+            self.gemini['calls'] += 1
+            self.gemini['errors'] += int(error)
+            self.gemini['seconds'] += seconds
+            if usage_metadata is None:
+                return
+            self.gemini['prompt_tokens'] += getattr(usage_metadata, 'prompt_token_count', 0) or 0
+            self.gemini['output_tokens'] += getattr(usage_metadata, 'candidates_token_count', 0) or 0
+
+    def _record_throttle(self, quota, seconds, retries):
+        with self._lock:
+            stats = self.throttle.setdefault(quota, {'calls': 0, 'retries': 0, 'seconds': 0.0})
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['seconds'] += seconds
+
+    def _record_cache_lookup(self, name, hit):
+        with self._lock:
+            stats = self.cache.setdefault(name, {'hits': 0, 'misses': 0})
+            stats['hits' if hit else 'misses'] += 1
+
+    @contextmanager
+    def activate(self):
+        """Makes this the pipeline that API and Gemini calls in the block are recorded on."""
+        token = _current_pipeline.set(self)
+        try:
+            yield self
+        finally:
+            _current_pipeline.reset(token)
+
+    @contextmanager
+    def trace(self, name):
+        """Activates this pipeline for the block, then logs its trace under name, even if the block raised."""
+        try:
+            with self.activate():
+                yield self
+        finally:
+            self.log_trace(name)
+
+    def iterate(self, iterable, name):
+        """Yields from iterable with this pipeline active, then logs its trace.
+
+        For generators that a streaming response consumes after the handler returned.
+        """
+        context = contextvars.copy_context()
+        context.run(_current_pipeline.set, self)
+        iterator = iter(iterable)
+        try:
+            while True:
+                try:
+                    item = context.run(next, iterator)
+                except StopIteration:
+                    return
+                yield item
+        finally:
+            self.log_trace(name)
+
+    def start(self, name, func):
+        """Runs func in the background as the stage called name."""
+        def timed():
+            start = time.perf_counter()
+            try:
+                with self.activate():
+                    return func()
+            finally:
+                self._record(name, start, time.perf_counter())
+        self._futures[name] = _stage_executor.submit(propagate(timed))
+
+    def result(self, name):
+        """Waits for a background stage and returns its result, re-raising any error it hit."""
+        start = time.perf_counter()
+        try:
+            return self._futures[name].result()
+        finally:
+            waited = time.perf_counter() - start
+            if waited > 0.001:
+                self._record(f'wait_{name}', start, start + waited)
+
+    @contextmanager
+    def stage(self, name):
+        """Times a block of work that runs on the request thread."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, start, time.perf_counter())
+
+    def summary(self):
+        """Returns the stage spans, per-service API usage, Gemini usage, rate-limit waits and cache lookups recorded so far."""
+        with self._lock:
+            return {
+                'total_seconds': round(time.perf_counter() - self.started_at, 3),
+                'stages': dict(sorted(self.timings.items(), key=lambda item: item[1]['start'])),
+                'api': {service: {**stats, 'seconds': round(stats['seconds'], 3)} for service, stats in sorted(self.api_calls.items())},
+                'gemini': {**self.gemini, 'seconds': round(self.gemini['seconds'], 3)},
+                'throttle': {quota: {**stats, 'seconds': round(stats['seconds'], 3)} for quota, stats in sorted(self.throttle.items())},
+                'cache': {name: dict(stats) for name, stats in sorted(self.cache.items())}
+            }
+
+    def log_trace(self, name):
+        if os.environ.get('TRACE_LOGS', '1') == '0':
+            return
+        _trace_logger.info(json.dumps({'severity': 'INFO', 'message': f'Trace for {name}', 'trace_name': name, 'trace': self.summary()}))
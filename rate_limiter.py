@@ -0,0 +1,179 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+import pipeline
+
+# Requests per minute this instance may send to each quota, from the per-user defaults
+# in the Slides, Drive and Vertex AI quota pages (the function's service account is
+# the user). Quotas are per project, so divide them by the number of instances that
+# share one. Override with RATE_LIMIT_<NAME> (e.g. RATE_LIMIT_SLIDES_WRITE); 0 disables.
+DEFAULT_REQUESTS_PER_MINUTE = {
+    'slides_read': 600,
+    'slides_write': 60,
+    'drive': 12000,
+    'vertex': 60,
+    'vertex_embedding': 600,
+}
+# A bucket holds this many seconds of its quota, so short bursts go out without waiting.
+BURST_SECONDS = 10
+
+MAX_RETRIES = 5
+RETRY_BASE_DELAY_SECONDS = 1.0
+RETRY_MAX_DELAY_SECONDS = 32.0
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# A write that failed with a 500, 502 or 504 may still have been applied, and sending it
+# again could create a second deck or email or clash with object IDs it already created.
+# Writes are only retried on errors that mean the request was turned away.
+RETRYABLE_WRITE_STATUSES = (429, 503)
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class _TokenBucket:
+    """Token bucket whose waiting callers are served round-robin across flows and FIFO within one.
+
+    A flow is one request's pipeline, so a request with many calls queued cannot
+    starve another request waiting on the same quota.
+    """
+
+    def __init__(self, name, per_minute):
+        self.name = name
+        self.per_minute = per_minute
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * BURST_SECONDS)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.granted = 0
+        self.retries = 0
+        self.throttled_seconds = 0.0
+        self.max_queued = 0
+        self._queued = 0
+        self._queues = OrderedDict()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, flow):
+        """Waits for this caller's turn and a token, and returns the seconds it waited."""
+        if not self.rate:
+            with self._condition:
+                self.granted += 1
+            return 0.0
+        start = time.monotonic()
+        ticket = object()
+        with self._condition:
+            self._queues.setdefault(flow, deque()).append(ticket)
+            self._queued += 1
+            self.max_queued = max(self.max_queued, self._queued)
+            while True:
+                self._refill()
+                head = next(iter(self._queues.values()))
+                if head[0] is not ticket:
+                    self._condition.wait()
+                elif self.tokens < 1:
+                    self._condition.wait((1 - self.tokens) / self.rate)
+                else:
+                    break
+            self.tokens -= 1
+            head.popleft()
+            # The flow goes to the back of the line, behind every other waiting flow.
+            del self._queues[flow]
+            if head:
+                self._queues[flow] = head
+            self._queued -= 1
+            waited = time.monotonic() - start
+            self.granted += 1
+            self.throttled_seconds += waited
+            self._condition.notify_all()
+        return waited
+
+    def backoff(self, quota_exhausted):
+        """Counts a retry; when the API reported the quota exhausted, also empties the bucket so every caller backs off."""
+        with self._condition:
+            self.retries += 1
+            if quota_exhausted and self.rate:
+                self._refill()
+                self.tokens = min(self.tokens, 0.0)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'requests_per_minute': self.per_minute,
+                'queued': self._queued,
+                'max_queued': self.max_queued,
+                'granted': self.granted,
+                'retries': self.retries,
+                'throttled_seconds': round(self.throttled_seconds, 3)
+            }
+
+
+def _bucket(name):
+    with _buckets_lock:
+        if name not in _buckets:
+            per_minute = float(os.environ.get(f'RATE_LIMIT_{name.upper()}', DEFAULT_REQUESTS_PER_MINUTE.get(name, 0)))
+            _buckets[name] = _TokenBucket(name, max(per_minute, 0.0))
+        return _buckets[name]
+
+
+def bucket_for(service_name, method):
+    """Returns the quota a Google API request counts against."""
+    if service_name == 'slides':
+        return 'slides_read' if method == 'GET' else 'slides_write'
+    return service_name
+
+
+def _retryable_status(err, statuses):
+    """Returns the HTTP status of err if it is one of statuses, or None."""
+    # HttpError carries it on resp; google.api_core errors (Vertex AI) on code.
+    resp = getattr(err, 'resp', None)
+    status = getattr(resp, 'status', None) if resp is not None else getattr(err, 'code', None)
+    try:
+        status = int(status)
+    except (TypeError, ValueError):
+        return None
+    return status if status in statuses else None
+
+
+def call(name, func, idempotent=True):
+    """Runs func() against the named quota: queued fairly for a token, and retried with jittered backoff on 429/5xx.
+
+    Calls that are not idempotent are only retried on 429 and 503. The time spent
+    queued or backing off is recorded on the current pipeline.
+    """
+    statuses = RETRYABLE_STATUSES if idempotent else RETRYABLE_WRITE_STATUSES
+    bucket = _bucket(name)
+    flow = pipeline.current() or threading.current_thread()
+    throttled = 0.0
+    retries = 0
+    try:
+        for attempt in range(MAX_RETRIES + 1):
+            throttled += bucket.acquire(flow)
+            try:
+                return func()
+            except Exception as err:
+                status = _retryable_status(err, statuses)
+                if status is None or attempt == MAX_RETRIES:
+                    raise
+                bucket.backoff(quota_exhausted=status == 429)
+                delay = min(RETRY_BASE_DELAY_SECONDS * 2 ** attempt, RETRY_MAX_DELAY_SECONDS) * random.uniform(0.5, 1.0)
+                logging.warning(f"{name} request returned {status}; retrying in {delay:.1f}s.")
+                time.sleep(delay)
+                throttled += delay
+                retries += 1
+    finally:
+        pipeline.record_throttle(name, throttled, retries)
+
+
+def stats():
+    """Returns the queue depth, throttle time and retries of every quota used so far on this instance."""
+    with _buckets_lock:
+        buckets = dict(_buckets)
+    return {name: bucket.stats() for name, bucket in sorted(buckets.items())}
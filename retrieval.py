@@ -0,0 +1,168 @@
+import logging
+import math
+import os
+import re
+import tempfile
+import zlib
+
+import numpy as np
+
+# Libraries with at most this many titled slides are sent to Gemini in full.
+# Override with RETRIEVAL_TOP_K; 0 disables pre-retrieval.
+DEFAULT_TOP_K = 150
+DEFAULT_EMBEDDINGS_DIR = os.path.join('/tmp', 'slide_embeddings')
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def slide_text(slide):
+    """The text a slide record is retrieved by: its title followed by its body content."""
+    return f"{slide.get('title', '')}\n{slide.get('content', '')}"
+
+
+class HashingEmbedder:
+    """Offline hashed TF-IDF backend: unigrams and bigrams hashed into a fixed number of buckets.
+
+    Vectors hold sublinear term frequencies only; IDF weights are derived from the
+    library matrix at query time, so per-deck vectors stay valid as the library changes.
+    """
+
+    uses_idf = True
+
+    def __init__(self, dimensions=1024):
+        self.dimensions = dimensions
+        self.name = f'hashed-{dimensions}'
+
+    def embed(self, texts):
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = _TOKEN_RE.findall(text.lower())
+            counts = {}
+            for term in tokens + [f'{a} {b}' for a, b in zip(tokens, tokens[1:])]:
+                # crc32 rather than hash(): str hashes are salted per process and
+                # the vectors are persisted across instances.
+                bucket = zlib.crc32(term.encode('utf-8'))
+                counts[bucket] = counts.get(bucket, 0) + 1
+            for bucket, count in counts.items():
+                # The bit above the bucket index picks a sign so collisions tend to cancel out.
+                sign = -1.0 if (bucket // self.dimensions) & 1 else 1.0
+                matrix[row, bucket % self.dimensions] += sign * (1.0 + math.log(count))
+        return matrix
+
+
+class VertexEmbedder:
+    """Vertex AI text-embedding backend, for use with a model from clients.get_embedding_model()."""
+
+    uses_idf = False
+    batch_size = 100
+
+    def __init__(self, model, model_name):
+        self.model = model
+        self.name = f'vertex-{model_name}'
+
+    def embed(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            embeddings = self.model.get_embeddings(texts[start:start + self.batch_size])
+            vectors.extend(embedding.values for embedding in embeddings)
+        return np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+
+
+class EmbeddingStore:
+    """Persists one embedding matrix per deck as a .npz file, keyed by backend and Drive revision."""
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.environ.get('SLIDE_EMBEDDINGS_DIR', DEFAULT_EMBEDDINGS_DIR)
+
+    def _path(self, backend_name, presentation_id):
+        return os.path.join(self.directory, backend_name, f'{presentation_id}.npz')
+
+    def load(self, backend_name, presentation_id, revision):
+        try:
+            with np.load(self._path(backend_name, presentation_id)) as data:
+                if str(data['revision']) == revision:
+                    return data['matrix']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # A damaged file is only a miss; the deck is embedded again and the file replaced.
+            logging.warning(f"Ignoring unreadable slide embeddings for presentation {presentation_id}: {e}")
+        return None
+
+    def save(self, backend_name, presentation_id, revision, matrix):
+        path = self._path(backend_name, presentation_id)
+        temp_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a uniquely named temporary file first, so concurrent writers in any
+            # thread or process never share one and readers never see a partial matrix.
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp.npz')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, revision=np.array(revision), matrix=matrix)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not persist slide embeddings for presentation {presentation_id}: {e}")
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class LibraryVectors:
+    """The embedding matrix of every slide in a library, ready to score queries against.
+
+    Rows are IDF-weighted (for backends that use IDF) and normalized, so one library
+    can be searched by any number of queries without embedding it again.
+    """
+
+    def __init__(self, decks, embedder, store=None):
+        self.embedder = embedder
+        self.matrix, self.idf = _embed_library(decks, embedder, store or EmbeddingStore())
+
+    def scores(self, query):
+        query_vector = self.embedder.embed([query])[0]
+        if self.idf is not None:
+            query_vector = query_vector * self.idf
+        return self.matrix @ _normalize_rows(query_vector[np.newaxis, :])[0]
+
+
+def _embed_library(decks, embedder, store):
+    matrices = []
+    for pres, deck_slides in decks:
+        if not deck_slides:
+            continue
+        revision = f"{pres.get('version')}:{pres.get('modified_time')}"
+        matrix = store.load(embedder.name, pres.get('id'), revision)
+        if matrix is None or matrix.shape[0] != len(deck_slides):
+            matrix = embedder.embed([slide_text(slide) for slide in deck_slides])
+            store.save(embedder.name, pres.get('id'), revision, matrix)
+        matrices.append(matrix)
+    library = np.vstack(matrices)
+    idf = None
+    if embedder.uses_idf:
+        document_frequency = np.count_nonzero(library, axis=0)
+        idf = np.log((1 + library.shape[0]) / (1 + document_frequency)) + 1.0
+        library = library * idf
+    return _normalize_rows(library), idf
+
+
+def select_candidates(query, decks, top_k, embedder=None, store=None, vectors=None):
+    """Returns the top_k slide records most similar to query, in library order.
+
+    decks is a list of (presentation, slides) pairs, where presentation carries the
+    Drive 'id', 'version' and 'modified_time' used to key the persisted vectors.
+    Pass the library's LibraryVectors to score several queries without re-embedding it.
+    """
+    slides = [slide for _, deck_slides in decks for slide in deck_slides]
+    if top_k <= 0 or len(slides) <= top_k:
+        return slides
+    vectors = vectors or LibraryVectors(decks, embedder or HashingEmbedder(), store)
+
+    scores = vectors.scores(query)
+    top_indices = np.sort(np.argpartition(-scores, top_k - 1)[:top_k])
+    logging.info(f"Pre-retrieval kept {top_k} of {len(slides)} slides using the '{vectors.embedder.name}' embedding backend.")
+    return [slides[i] for i in top_indices]
@@ -0,0 +1,84 @@
+import logging
+
+
+class Deck:
+    """One library presentation and its titled slides.
+
+    Presentation metadata lives here once instead of on every slide record. Body
+    text is only needed to embed slides whose vectors are not stored yet, so decks
+    served from the slide index load it on first use through load_contents, which
+    returns a {slide_id: content} mapping (or None if it is no longer available).
+    """
+
+    __slots__ = ('presentation_id', 'presentation_name', 'slides', '_contents', '_load_contents')
+
+    def __init__(self, presentation_id, presentation_name, rows, contents=None, load_contents=None):
+        self.presentation_id = presentation_id
+        self.presentation_name = presentation_name
+        self.slides = [SlideRecord(self, title, slide_id, slide_number) for title, slide_id, slide_number in rows]
+        self._contents = contents
+        self._load_contents = load_contents
+
+    @classmethod
+    def from_records(cls, presentation_id, presentation_name, records):
+        """Builds a deck from the dict records extract_slides_from_presentation() returns."""
+        return cls(
+            presentation_id,
+            presentation_name,
+            [(r['title'], r['slide_id'], r['slide_number']) for r in records],
+            contents={r['slide_id']: r['content'] for r in records}
+        )
+
+    def content(self, slide_id):
+        if self._contents is None:
+            # Concurrent first reads may both load; they store the same mapping.
+            contents = self._load_contents() if self._load_contents else None
+            if contents is None:
+                logging.warning(f"Slide text of presentation {self.presentation_id} is no longer indexed; using titles only.")
+                contents = {}
+            self._contents = contents
+        return self._contents.get(slide_id, '')
+
+
+class SlideRecord:
+    """A titled library slide. Reads like the dict records it replaces: record['title'], record.get('content')."""
+
+    __slots__ = ('deck', 'title', 'slide_id', 'slide_number')
+
+    FIELDS = frozenset(('title', 'content', 'slide_id', 'presentation_id', 'presentation_name', 'slide_number'))
+
+    def __init__(self, deck, title, slide_id, slide_number):
+        self.deck = deck
+        self.title = title
+        self.slide_id = slide_id
+        self.slide_number = slide_number
+
+    @property
+    def presentation_id(self):
+        return self.deck.presentation_id
+
+    @property
+    def presentation_name(self):
+        return self.deck.presentation_name
+
+    @property
+    def content(self):
+        return self.deck.content(self.slide_id)
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+    def reference(self):
+        """The slim, JSON-ready form of the slide returned in responses; its body text is left out."""
+        return {
+            'title': self.title,
+            'slide_id': self.slide_id,
+            'presentation_id': self.deck.presentation_id,
+            'presentation_name': self.deck.presentation_name,
+            'slide_number': self.slide_number
+        }
@@ -0,0 +1,89 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+
+# Cloud Functions only allow writes under /tmp, which survives for the lifetime
+# of a warm instance. Point SLIDE_INDEX_PATH at a persistent disk for local runs.
+DEFAULT_INDEX_PATH = os.path.join('/tmp', 'slide_index.sqlite3')
+# Bumped when the stored layout changes; older tables are dropped and rebuilt on first use.
+SCHEMA_VERSION = 2
+
+
+class SlideIndex:
+    """On-disk index of extracted slide records, keyed by presentation ID and Drive revision.
+
+    Titles and IDs are stored apart from body text, so loading a deck's slides does
+    not parse text that only embedding and speaker notes need.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get('SLIDE_INDEX_PATH', DEFAULT_INDEX_PATH)
+        with self._connect() as conn:
+            if conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+                conn.execute('DROP TABLE IF EXISTS decks')
+                conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS decks (
+                       presentation_id TEXT PRIMARY KEY,
+                       version TEXT,
+                       modified_time TEXT,
+                       presentation_name TEXT,
+                       slides_json TEXT NOT NULL,
+                       contents_json TEXT NOT NULL,
+                       indexed_at REAL NOT NULL
+                   )"""
+            )
+
+    def _connect(self):
+        # A short-lived connection per call keeps the index safe to use from
+        # worker threads without sharing a sqlite3 connection between them.
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, presentation_id, version, modified_time):
+        """Returns the cached [title, slide_id, slide_number] rows of a deck's slides, or None if the revision changed."""
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    'SELECT version, modified_time, slides_json FROM decks WHERE presentation_id = ?',
+                    (presentation_id,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Slide index lookup failed for presentation {presentation_id}: {e}")
+            return None
+        if not row or row[0] != version or row[1] != modified_time:
+            return None
+        return json.loads(row[2])
+
+    def get_contents(self, presentation_id, version=None, modified_time=None):
+        """Returns {slide_id: body text} for a deck, or None if it is not indexed.
+
+        With a version and modified_time, also None if the indexed revision differs.
+        """
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    'SELECT version, modified_time, contents_json FROM decks WHERE presentation_id = ?',
+                    (presentation_id,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Slide index lookup failed for presentation {presentation_id}: {e}")
+            return None
+        if not row or (version is not None and (row[0] != version or row[1] != modified_time)):
+            return None
+        return json.loads(row[2])
+
+    def put(self, presentation_id, version, modified_time, presentation_name, slides):
+        """Stores the slide records extracted from a deck at the given revision."""
+        rows = [[s['title'], s['slide_id'], s['slide_number']] for s in slides]
+        contents = {s['slide_id']: s['content'] for s in slides}
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO decks VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (presentation_id, version, modified_time, presentation_name, json.dumps(rows), json.dumps(contents), time.time())
+                )
+        except sqlite3.Error as e:
+            # The index is only an optimization; a failed write just means a re-read next time.
+            logging.warning(f"Could not write presentation {presentation_id} to the slide index: {e}")
@@ -0,0 +1,85 @@
+import re
+import unicodedata
+from collections import defaultdict, deque
+
+# Minimum trigram (Dice) similarity for a fuzzy title match.
+DEFAULT_FUZZY_THRESHOLD = 0.6
+
+_PUNCTUATION_RE = re.compile(r'[^\w\s]')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_title(title):
+    """Case-folds a title and drops punctuation and repeated whitespace, so small LLM rewrites still match."""
+    title = unicodedata.normalize('NFKC', title or '').casefold()
+    title = _PUNCTUATION_RE.sub(' ', title)
+    return _WHITESPACE_RE.sub(' ', title).strip()
+
+
+def _trigrams(text):
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TitleIndex:
+    """Maps normalized slide titles to queues of slide records, in library order.
+
+    take() returns and consumes the next slide for a title in O(1). When no title
+    matches exactly after normalization, an optional trigram index finds the most
+    similar remaining title instead.
+    """
+
+    def __init__(self, slides, fuzzy=True, fuzzy_threshold=DEFAULT_FUZZY_THRESHOLD):
+        self.fuzzy = fuzzy
+        self.fuzzy_threshold = fuzzy_threshold
+        self.exact_matches = 0
+        self.fuzzy_matches = 0
+        self.unmatched = []
+        self._queues = defaultdict(deque)
+        for slide in slides:
+            self._queues[normalize_title(slide['title'])].append(slide)
+        self._trigram_keys = defaultdict(set)
+        self._key_trigrams = {}
+        if fuzzy:
+            for key in self._queues:
+                grams = _trigrams(key)
+                self._key_trigrams[key] = grams
+                for gram in grams:
+                    self._trigram_keys[gram].add(key)
+
+    def take(self, title):
+        """Returns and consumes the next slide matching title, or None if nothing matches."""
+        key = normalize_title(title)
+        queue = self._queues.get(key)
+        if queue:
+            self.exact_matches += 1
+            return self._pop(key)
+        if self.fuzzy:
+            key = self._closest_key(key)
+            if key is not None:
+                self.fuzzy_matches += 1
+                return self._pop(key)
+        self.unmatched.append(title)
+        return None
+
+    def _pop(self, key):
+        queue = self._queues[key]
+        slide = queue.popleft()
+        if not queue:
+            # Exhausted titles can no longer be fuzzy-matched.
+            for gram in self._key_trigrams.pop(key, ()):
+                self._trigram_keys[gram].discard(key)
+        return slide
+
+    def _closest_key(self, key):
+        grams = _trigrams(key)
+        shared = defaultdict(int)
+        for gram in grams:
+            for candidate in self._trigram_keys.get(gram, ()):
+                shared[candidate] += 1
+        best_key, best_score = None, self.fuzzy_threshold
+        for candidate, count in shared.items():
+            score = 2 * count / (len(grams) + len(self._key_trigrams[candidate]))
+            if score > best_score or (best_key is None and score == best_score):
+                best_key, best_score = candidate, score
+        return best_key
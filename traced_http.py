@@ -0,0 +1,37 @@
+import time
+
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+
+import pipeline
+import rate_limiter
+
+
+class TracedHttpRequest(HttpRequest):
+    """An HttpRequest that goes through its API's rate limiter and reports its service, payload sizes and duration to the current pipeline."""
+
+    def __init__(self, service_name, http, postproc, *args, **kwargs):
+        super().__init__(http, self._measure_response, *args, **kwargs)
+        self._service_name = service_name
+        self._parse_response = postproc
+        self._response_bytes = 0
+
+    def _measure_response(self, resp, content):
+        self._response_bytes = len(content or b'')
+        return self._parse_response(resp, content)
+
+    def execute(self, http=None, num_retries=0):
+        # Throttled and retried as a whole; every attempt is traced as its own call.
+        return rate_limiter.call(rate_limiter.bucket_for(self._service_name, self.method), lambda: self._execute_once(http, num_retries),
+                                 idempotent=self.method == 'GET')
+
+    def _execute_once(self, http, num_retries):
+        start = time.perf_counter()
+        error = False
+        try:
+            return super().execute(http=http, num_retries=num_retries)
+        except HttpError:
+            error = True
+            raise
+        finally:
+            pipeline.record_api_call(self._service_name, len(self.body or ''), self._response_bytes, time.perf_counter() - start, error)